@@ -1,20 +1,139 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify
+from flask import Flask, render_template, stream_template, stream_with_context, request, redirect, url_for, flash, send_file, send_from_directory, jsonify, abort, g, session, make_response
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_
-from werkzeug.utils import secure_filename
+from sqlalchemy import or_, and_, case, func, select, insert, update, cast, event, inspect, false, true, text, literal, literal_column, desc, type_coerce, union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.hybrid import hybrid_property
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import safe_join
+from collections import namedtuple
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date
+from functools import wraps
 from dateutil.relativedelta import relativedelta
+from xml.sax.saxutils import escape as xml_escape
+import base64
+import csv
+import hashlib
+import io
+import json
+import mimetypes
 import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # без Pillow уменьшенные копии не создаются, страницы показывают оригиналы
+    Image = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key_here'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///sales.db'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp'}
+app.config['MAX_CONTENT_LENGTH'] = 25 * 1024 * 1024  # ограничение размера запроса (фото с камеры + поля формы)
+app.config['UPLOAD_TEMP_FOLDER'] = os.path.join('uploads', 'incoming')
+app.config['UPLOAD_CHUNK_SIZE'] = 64 * 1024
+app.config['SALES_PER_PAGE'] = 50
+
+# Потоковая отрисовка длинных списков (?all=1 у продаж, страницы стока) и выгрузки CSV/XLSX:
+# строки читаются с курсора пачками по STREAM_BATCH_SIZE, ответ уходит кусками не меньше STREAM_CHUNK_SIZE байт
+app.config['STREAM_BATCH_SIZE'] = 200
+app.config['STREAM_CHUNK_SIZE'] = 16 * 1024
+
+# Уменьшенные WebP-копии фото для карточек: вариант -> максимальная сторона в пикселях
+app.config['PHOTO_VARIANTS'] = {'card': 720}
+app.config['PHOTO_VARIANTS_FOLDER'] = os.path.join('uploads', 'variants')
+app.config['PHOTO_WEBP_QUALITY'] = 80
+app.config['PHOTO_CACHE_MAX_AGE'] = 365 * 24 * 3600  # фото по хэшу не меняются
+
+# Продакшен-режим SQLite (несколько воркеров gunicorn): в WAL чтение отчетов не блокирует запись продаж
+app.config['SQLITE_PRODUCTION_MODE'] = True
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',        # в WAL надежно и без fsync на каждый commit
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,       # отрицательное значение — размер в КиБ (64 МБ)
+    'busy_timeout': 5000,           # мс ожидания блокировки другим воркером
+}
+app.config['SQLITE_WRITE_RETRIES'] = 3
+app.config['SQLITE_WRITE_RETRY_DELAY'] = 0.2  # секунды, растет с каждой попыткой
+
+# Кэш отрисованных отчетов, общий для всех воркеров (отдельный файл SQLite, чтобы не занимать запись в основной базе)
+app.config['REPORT_CACHE_PATH'] = os.path.join(app.instance_path, 'report_cache.db')
+app.config['REPORT_CACHE_TTL'] = 10 * 60       # секунды
+app.config['REPORT_CACHE_MAX_ENTRIES'] = 500   # сверх этого вытесняются давно не читанные
+
+# Импорт CSV: строк в одной транзакции и сколько ошибок по строкам показывать в отчете
+app.config['IMPORT_BATCH_SIZE'] = 500
+app.config['IMPORT_MAX_ERRORS'] = 200
+
+# Сколько периодов можно сравнить за один запрос (?compare=1 на dashboard и /api/dashboard/compare)
+app.config['COMPARE_MAX_PERIODS'] = 12
+
+# Переопределение настроек из окружения: FLASK_<ИМЯ>, например FLASK_SQLALCHEMY_DATABASE_URI (тесты)
+app.config.from_prefixed_env()
 
 db = SQLAlchemy(app)
 
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """PRAGMA для каждого нового соединения пула"""
+    if not isinstance(dbapi_connection, sqlite3.Connection) or not app.config['SQLITE_PRODUCTION_MODE']:
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+# Все изменения данных идут через write_transaction. Внутри процесса записи выполняются по очереди,
+# между воркерами блокировку записи заранее берет BEGIN IMMEDIATE (с ограниченными повторами),
+# поэтому commit не падает с "database is locked" посреди flush
+write_lock = threading.Lock()
+
+
+def is_database_locked(error):
+    message = str(error.orig).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def begin_write():
+    """BEGIN IMMEDIATE с повторами, пока база занята другим воркером"""
+    retries = app.config['SQLITE_WRITE_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            db.session.execute(text('BEGIN IMMEDIATE'))
+            return
+        except OperationalError as error:
+            db.session.rollback()
+            if not is_database_locked(error) or attempt == retries:
+                raise
+            time.sleep(app.config['SQLITE_WRITE_RETRY_DELAY'] * (attempt + 1))
+
+
+@contextmanager
+def write_transaction():
+    """Сериализованная транзакция записи: все изменения в блоке фиксируются одним commit"""
+    with write_lock:
+        begin_write()
+        try:
+            yield
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
 class City(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
@@ -56,10 +175,33 @@ class Sale(db.Model):
     investor = db.relationship('Investor', backref='sales')
     expenses = db.relationship('Expense', backref='sale', lazy=True, cascade="all, delete-orphan")
 
-    @property
+    # Индексы создаются миграцией 004 (migrations.py)
+    __table_args__ = (
+        db.Index('ix_sale_date', 'date'),
+        db.Index('ix_sale_city_id_date', 'city_id', 'date'),
+        db.Index('ix_sale_investor_id_date', 'investor_id', 'date'),
+        db.Index('ix_sale_photo', 'photo'),
+    )
+
+    @hybrid_property
+    def expenses_total(self):
+        return sum(e.amount for e in self.expenses)
+
+    @expenses_total.expression
+    def expenses_total(cls):
+        # Коррелированный подзапрос, чтобы сортировать и фильтровать по расходам в SQL
+        return select(func.coalesce(func.sum(Expense.amount), 0)) \
+            .where(Expense.sale_id == cls.id) \
+            .correlate_except(Expense) \
+            .scalar_subquery()
+
+    @hybrid_property
     def profit(self):
-        total_expenses = sum(e.amount for e in self.expenses)
-        return self.sell_price - self.buy_price - total_expenses
+        return self.sell_price - self.buy_price - self.expenses_total
+
+    @profit.expression
+    def profit(cls):
+        return cls.sell_price - cls.buy_price - cls.expenses_total
 
 
 class Expense(db.Model):
@@ -71,6 +213,8 @@ class Expense(db.Model):
 
     expense_type = db.relationship('ExpenseType', backref='expenses')
 
+    __table_args__ = (db.Index('ix_expense_sale_id', 'sale_id'),)
+
 
 class GeneralExpense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -83,6 +227,8 @@ class GeneralExpense(db.Model):
     expense_type = db.relationship('ExpenseType', backref='general_expenses')
     city = db.relationship('City', backref='general_expenses')
 
+    __table_args__ = (db.Index('ix_general_expense_date_city_id', 'date', 'city_id'),)
+
 
 class StockExpense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -94,6 +240,8 @@ class StockExpense(db.Model):
     expense_type = db.relationship('ExpenseType', backref='stock_expenses')
     stock_item = db.relationship('StockItem', backref='expenses')
 
+    __table_args__ = (db.Index('ix_stock_expense_stock_item_id', 'stock_item_id'),)
+
 
 class Investor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -119,6 +267,13 @@ class StockItem(db.Model):
     city = db.relationship('City', backref='stock_items')
     investor = db.relationship('Investor', backref='stock_items')
 
+    # Частичные индексы: только непроданные позиции (условие совпадает с active_stock_condition)
+    __table_args__ = (
+        db.Index('ix_stock_item_active_city_id', 'city_id', sqlite_where=text('sold = 0')),
+        db.Index('ix_stock_item_active_investor_id', 'investor_id', sqlite_where=text('sold = 0')),
+        db.Index('ix_stock_item_photo', 'photo'),
+    )
+
     @property
     def total_invested(self):
         return self.buy_price * self.quantity
@@ -128,13 +283,1090 @@ class StockItem(db.Model):
         return (self.expected_sell_price - self.buy_price) * self.quantity
 
 
+class SalesRollup(db.Model):
+    """Итоги продаж по городу, инвестору и месяцу. Поддерживается при каждом flush продаж и расходов"""
+    __tablename__ = 'sales_rollup'
+
+    id = db.Column(db.Integer, primary_key=True)
+    city_id = db.Column(db.Integer, db.ForeignKey('city.id'), nullable=False)
+    investor_id = db.Column(db.Integer, db.ForeignKey('investor.id'), nullable=True)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    sales_count = db.Column(db.Integer, nullable=False, default=0)
+    total_buy = db.Column(db.Float, nullable=False, default=0)
+    total_sell = db.Column(db.Float, nullable=False, default=0)
+    total_expenses = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (db.Index('ix_sales_rollup_period', 'year', 'month', 'city_id'),)
+
+
+class DataVersion(db.Model):
+    """Счетчики версий данных: по ним все процессы gunicorn узнают, что их кэш устарел"""
+    __tablename__ = 'data_version'
+
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+def get_data_version(name):
+    return db.session.query(DataVersion.version).filter_by(name=name).scalar() or 0
+
+
+def bump_data_version(name, connection=None):
+    """Увеличивает версию в текущей транзакции (атомарно, без гонки между процессами)"""
+    stmt = sqlite_insert(DataVersion.__table__).values(name=name, version=1)
+    stmt = stmt.on_conflict_do_update(index_elements=['name'], set_={'version': DataVersion.__table__.c.version + 1})
+    (connection or db.session.connection()).execute(stmt)
+
+
+# Кэш справочников (города, типы расходов, сотрудники, инвесторы) в памяти процесса.
+# Справочники меняются редко, поэтому вместо четырех SELECT на каждый запрос проверяем одну версию.
+RefItem = namedtuple('RefItem', ['id', 'name'])
+
+
+class ReferenceData:
+    """Снимок справочников: списки для форм и словари name→id / id→name"""
+
+    def __init__(self, version):
+        self.version = version
+        self.cities = self._load(City)
+        self.expense_types = self._load(ExpenseType)
+        self.employees = self._load(Employee)
+        self.investors = self._load(Investor)
+
+        self.city_ids, self.city_names = self._maps(self.cities)
+        self.expense_type_ids, self.expense_type_names = self._maps(self.expense_types)
+        self.employee_ids, self.employee_names = self._maps(self.employees)
+        self.investor_ids, self.investor_names = self._maps(self.investors)
+
+    @staticmethod
+    def _load(model):
+        return [RefItem(row.id, row.name) for row in db.session.query(model.id, model.name).order_by(model.id)]
+
+    @staticmethod
+    def _maps(items):
+        ids = {}
+        for item in items:
+            ids.setdefault(item.name, item.id)  # у сотрудников имена могут повторяться — берем первого
+        return ids, {item.id: item.name for item in items}
+
+
+REFERENCE_MODELS = (City, ExpenseType, Employee, Investor)
+reference_cache = {}
+
+
+def get_reference_data():
+    """Справочники из кэша процесса; перечитываются, если версия 'reference' в базе изменилась"""
+    if 'reference_data' not in g:
+        version = get_data_version('reference')
+        data = reference_cache.get('data')
+        if data is None or data.version != version:
+            data = ReferenceData(version)
+            reference_cache['data'] = data
+        g.reference_data = data
+    return g.reference_data
+
+
+# Версии данных для условных GET отчетов: своя версия у каждой таблицы и общая 'global'.
+# Отчет отдает 304, пока версии таблиц, из которых он строится, не изменились.
+# Версия 'reference' заодно сбрасывает кэш справочников во всех процессах (get_reference_data)
+VERSIONED_MODELS = {
+    Sale: 'sale',
+    Expense: 'expense',
+    StockItem: 'stock_item',
+    StockExpense: 'stock_expense',
+    GeneralExpense: 'general_expense',
+}
+
+
+@event.listens_for(db.session, 'before_flush')
+def bump_table_versions(session, flush_context, instances):
+    """Увеличивает версии измененных таблиц и общую версию в той же транзакции"""
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    tables = {VERSIONED_MODELS[type(obj)] for obj in changed if type(obj) in VERSIONED_MODELS}
+    if any(isinstance(obj, REFERENCE_MODELS) for obj in changed):
+        tables.add('reference')
+    if tables:
+        connection = session.connection()
+        for name in sorted(tables | {'global'}):
+            bump_data_version(name, connection)
+
+
+def get_data_versions(names):
+    """Версии нескольких счетчиков одним запросом"""
+    rows = db.session.query(DataVersion.name, DataVersion.version).filter(DataVersion.name.in_(names)).all()
+    versions = dict(rows)
+    return [versions.get(name, 0) for name in names]
+
+
+# Шаблоны и код тоже входят в ETag: после обновления приложения браузер получит новую страницу
+RENDER_STAMP = max(
+    os.path.getmtime(path)
+    for path in [os.path.abspath(__file__)] + [
+        os.path.join(app.root_path, app.template_folder, name)
+        for name in os.listdir(os.path.join(app.root_path, app.template_folder))
+    ]
+)
+
+
+def report_key(tables, report_args):
+    """Ключ отчета (ETag и ключ кэша): маршрут, разобранные фильтры, версии таблиц, текущая дата и шаблоны"""
+    key = json.dumps([
+        request.endpoint,
+        request.view_args,
+        report_args,
+        get_data_versions(tables),
+        date.today().isoformat(),
+        RENDER_STAMP,
+    ], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class ReportCache:
+    """Отрисованные страницы отчетов в отдельной базе SQLite, общей для воркеров gunicorn.
+    Версии данных входят в ключ, поэтому после записи старые страницы просто перестают находиться
+    и вытесняются по TTL или как давно не читанные. Ошибки кэша не ломают отчет — он считается заново"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            os.makedirs(os.path.dirname(app.config['REPORT_CACHE_PATH']), exist_ok=True)
+            connection = sqlite3.connect(app.config['REPORT_CACHE_PATH'], timeout=1, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = OFF")  # потеря кэша при сбое не страшна
+            connection.execute("""CREATE TABLE IF NOT EXISTS report_cache (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_report_cache_accessed_at ON report_cache (accessed_at)")
+            self.local.connection = connection
+        return self.local.connection
+
+    def get(self, key):
+        now = time.time()
+        try:
+            connection = self.connection()
+            row = connection.execute("SELECT body FROM report_cache WHERE key = ? AND created_at > ?",
+                                     (key, now - app.config['REPORT_CACHE_TTL'])).fetchone()
+            if row is not None:
+                connection.execute("UPDATE report_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error:
+            app.logger.warning('Кэш отчетов недоступен', exc_info=True)
+            return None
+        return row[0] if row else None
+
+    def set(self, key, body):
+        now = time.time()
+        connection = None
+        try:
+            connection = self.connection()
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("INSERT OR REPLACE INTO report_cache (key, body, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                               (key, body, now, now))
+            connection.execute("DELETE FROM report_cache WHERE created_at <= ?", (now - app.config['REPORT_CACHE_TTL'],))
+            connection.execute("""DELETE FROM report_cache WHERE key IN (
+                SELECT key FROM report_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )""", (app.config['REPORT_CACHE_MAX_ENTRIES'],))
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            app.logger.warning('Не удалось сохранить отчет в кэш', exc_info=True)
+            if connection is not None and connection.in_transaction:
+                connection.execute("ROLLBACK")
+
+
+report_cache = ReportCache()
+
+
+def versioned_report(*tables, filters=None, mimetype='text/html'):
+    """Декоратор отчета: отвечает 304 Not Modified без тяжелых запросов, если данные не менялись,
+    а страницу, уже отрисованную любым воркером для тех же фильтров и версий, берет из report_cache.
+    filters(args) — фильтры отчета в каноническом виде (без значений по умолчанию и лишних параметров):
+    по ним строится ключ, поэтому /dashboard и /dashboard?year=...&month=... текущего месяца — одна запись.
+    Результат лежит в g.report_args — ссылки и формы отчета строятся из него, а не из request.args.
+    mimetype — тип ответа из кэша (в кэше хранится только тело)"""
+    tables = list(tables) or ['global']
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.report_args = filters(request.args) if filters else {}
+            # Ожидающие flash-сообщения должны быть показаны, поэтому такую страницу рендерим заново
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            etag = report_key(tables, g.report_args)
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                body = report_cache.get(etag)
+                if body is not None:
+                    response = make_response(body)
+                    response.mimetype = mimetype
+                else:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code == 200:
+                        report_cache.set(etag, response.get_data())
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+# Строки списков для шаблонов: читаются одной выборкой Core без ORM-объектов, связи заменены
+# именами из справочников, суммы и прибыль посчитаны заранее — рендеринг не ходит в базу
+ExpenseLine = namedtuple('ExpenseLine', ['type_name', 'amount'])
+
+
+class SaleRow:
+    """Карточка продажи (index.html, investor_sales_history.html)"""
+    __slots__ = ('id', 'photo', 'product_name', 'reference', 'buy_price', 'sell_price', 'date',
+                 'city_name', 'employee_name', 'investor_name', 'expenses', 'expenses_total', 'profit')
+
+    def __init__(self, row, ref, expenses):
+        self.id = row.id
+        self.photo = row.photo
+        self.product_name = row.product_name
+        self.reference = row.reference
+        self.buy_price = row.buy_price
+        self.sell_price = row.sell_price
+        self.date = row.date
+        self.city_name = ref.city_names.get(row.city_id)
+        self.employee_name = ref.employee_names.get(row.employee_id)
+        self.investor_name = ref.investor_names.get(row.investor_id)
+        self.expenses = expenses
+        self.expenses_total = row.expenses_total
+        self.profit = row.sell_price - row.buy_price - row.expenses_total
+
+
+def sale_row_columns():
+    """Колонки продажи для SaleRow (расходы суммируются в SQL)"""
+    return (Sale.id, Sale.photo, Sale.product_name, Sale.reference, Sale.buy_price, Sale.sell_price, Sale.date,
+            Sale.city_id, Sale.employee_id, Sale.investor_id, Sale.expenses_total.label('expenses_total'))
+
+
+class StockRow:
+    """Карточка позиции стока (stock_city_detail.html, stock_investor_detail.html)"""
+    __slots__ = ('id', 'photo', 'product_name', 'reference', 'buy_price', 'expected_sell_price', 'quantity',
+                 'date_added', 'city_name', 'investor_name', 'total_invested', 'expected_profit')
+
+    def __init__(self, row, ref):
+        self.id = row.id
+        self.photo = row.photo
+        self.product_name = row.product_name
+        self.reference = row.reference
+        self.buy_price = row.buy_price
+        self.expected_sell_price = row.expected_sell_price
+        self.quantity = row.quantity
+        self.date_added = row.date_added
+        self.city_name = ref.city_names.get(row.city_id)
+        self.investor_name = ref.investor_names.get(row.investor_id)
+        self.total_invested = row.buy_price * row.quantity
+        self.expected_profit = (row.expected_sell_price - row.buy_price) * row.quantity
+
+
+# Единственное определение "активного" (непроданного) стока для всех страниц стока.
+# false() рендерится литералом (sold = 0), поэтому SQLite подбирает частичные индексы ix_stock_item_active_*
+def active_stock_condition():
+    return StockItem.sold == false()
+
+
+def active_stock_rows(*criteria):
+    """Непроданные позиции стока для карточек, в порядке добавления — генератор StockRow
+    по одному SELECT без связей; строки читаются с курсора пачками (yield_per)"""
+    ref = get_reference_data()
+    rows = db.session.execute(
+        select(StockItem.id, StockItem.photo, StockItem.product_name, StockItem.reference, StockItem.buy_price,
+               StockItem.expected_sell_price, StockItem.quantity, StockItem.date_added, StockItem.city_id,
+               StockItem.investor_id)
+        .where(active_stock_condition(), *criteria)
+        .order_by(StockItem.id),
+        execution_options={'yield_per': app.config['STREAM_BATCH_SIZE']})
+    for row in rows:
+        yield StockRow(row, ref)
+
+
+# Агрегаты стока считаются в SQL, чтобы не загружать каждую позицию в Python
+def stock_totals_columns():
+    """Колонки SUM для позиций, вложений и ожидаемой прибыли по стоку"""
+    return (
+        func.coalesce(func.sum(StockItem.quantity), 0).label('positions'),
+        func.coalesce(func.sum(StockItem.buy_price * StockItem.quantity), 0).label('invested'),
+        func.coalesce(func.sum((StockItem.expected_sell_price - StockItem.buy_price) * StockItem.quantity), 0).label('expected_profit'),
+    )
+
+
+def get_stock_totals(*criteria):
+    """Итоги по непроданному стоку одним запросом (дополнительные фильтры через criteria)"""
+    return db.session.query(*stock_totals_columns()).filter(active_stock_condition(), *criteria).one()
+
+
+def get_stock_totals_by_city():
+    """Итоги по непроданному стоку в разрезе городов (только города со стоком)"""
+    return db.session.query(City.name, *stock_totals_columns()) \
+        .join(StockItem, StockItem.city_id == City.id) \
+        .filter(active_stock_condition()) \
+        .group_by(City.id, City.name) \
+        .order_by(City.name) \
+        .all()
+
+
+def get_stock_totals_by_investor():
+    """Итоги по непроданному стоку в разрезе инвесторов вместе со списком их городов"""
+    # Уникальные пары инвестор/город, отсортированные по названию города
+    investor_cities = db.session.query(StockItem.investor_id.label('investor_id'), City.name.label('city_name')) \
+        .join(City, StockItem.city_id == City.id) \
+        .filter(active_stock_condition()) \
+        .distinct() \
+        .order_by(City.name) \
+        .subquery()
+    cities_by_investor = db.session.query(
+        investor_cities.c.investor_id,
+        func.group_concat(investor_cities.c.city_name, ', ').label('cities')
+    ).group_by(investor_cities.c.investor_id).subquery()
+
+    return db.session.query(Investor.name, *stock_totals_columns(), cities_by_investor.c.cities) \
+        .join(StockItem, StockItem.investor_id == Investor.id) \
+        .join(cities_by_investor, cities_by_investor.c.investor_id == Investor.id) \
+        .filter(active_stock_condition()) \
+        .group_by(Investor.id, Investor.name, cities_by_investor.c.cities) \
+        .order_by(Investor.name) \
+        .all()
+
+
+# Итоги по продажам считаются агрегатом по всему отфильтрованному набору, а не по загруженной странице
+def sales_totals_columns():
+    """Колонки COUNT/SUM для количества, дохода, закупки и расходов по продажам"""
+    return (
+        func.count(Sale.id).label('count'),
+        func.coalesce(func.sum(Sale.sell_price), 0).label('gross_income'),
+        func.coalesce(func.sum(Sale.buy_price), 0).label('total_buy'),
+        func.coalesce(func.sum(Sale.expenses_total), 0).label('total_expenses'),
+    )
+
+
+def get_sales_totals(sales_query):
+    """Итоги по запросу продаж одним агрегатным запросом"""
+    return sales_query.order_by(None).with_entities(*sales_totals_columns()).one()
+
+
+def get_general_expenses_total(start, end, *criteria):
+    """Сумма общих расходов за период одним запросом"""
+    return db.session.query(func.coalesce(func.sum(GeneralExpense.amount), 0)) \
+        .filter(GeneralExpense.date >= start, GeneralExpense.date < end, *criteria) \
+        .scalar()
+
+
+def get_period_totals(periods, sale_criteria=(), general_criteria=()):
+    """KPI нескольких периодов одним запросом: условная агрегация (CASE WHEN дата в периоде)
+    по продажам и общим расходам. Возвращает PeriodTotals в порядке periods"""
+    sale_columns = []
+    general_columns = []
+    for index, period in enumerate(periods):
+        in_sale_period = and_(Sale.date >= period.start, Sale.date < period.end)
+        in_general_period = and_(GeneralExpense.date >= period.start, GeneralExpense.date < period.end)
+        sale_columns += [
+            func.count(case((in_sale_period, Sale.id))).label(f'count_{index}'),
+            func.coalesce(func.sum(case((in_sale_period, Sale.sell_price))), 0).label(f'gross_income_{index}'),
+            func.coalesce(func.sum(case((in_sale_period, Sale.buy_price))), 0).label(f'total_buy_{index}'),
+            func.coalesce(func.sum(case((in_sale_period, Sale.expenses_total))), 0).label(f'total_expenses_{index}'),
+        ]
+        general_columns.append(
+            func.coalesce(func.sum(case((in_general_period, GeneralExpense.amount))), 0).label(f'general_{index}'))
+
+    # Строки вне всех периодов отсекаются индексом по дате, остальные проходятся один раз
+    sales = select(*sale_columns) \
+        .where(or_(*(and_(Sale.date >= p.start, Sale.date < p.end) for p in periods)), *sale_criteria) \
+        .subquery()
+    general = select(*general_columns) \
+        .where(or_(*(and_(GeneralExpense.date >= p.start, GeneralExpense.date < p.end) for p in periods)),
+               *general_criteria) \
+        .subquery()
+    # Обе части — по одной строке, соединяются в один SELECT
+    row = db.session.execute(select(sales, general).select_from(sales.join(general, true()))).one()._mapping
+
+    totals = []
+    for index, period in enumerate(periods):
+        gross_income = row[f'gross_income_{index}']
+        total_buy = row[f'total_buy_{index}']
+        total_expenses = row[f'total_expenses_{index}']
+        general_expenses = row[f'general_{index}']
+        totals.append(PeriodTotals(period, row[f'count_{index}'], gross_income, total_buy, total_expenses,
+                                   general_expenses, gross_income - total_buy - total_expenses - general_expenses))
+    return totals
+
+
+def get_expense_timeline(start, end, sale_criteria=(), general_criteria=()):
+    """Лента расходов по дням одним запросом UNION ALL: расходы продаж (по дате продажи) и общие расходы.
+    Возвращает [(день, [строки с type, amount, description, is_sale_expense])] от новых дней к старым"""
+    sale_expenses = select(
+        type_coerce(func.date(Sale.date), db.Date).label('day'),
+        ExpenseType.name.label('type'),
+        Expense.amount.label('amount'),
+        Expense.comment.label('description'),
+        literal(True).label('is_sale_expense'),
+        Sale.date.label('moment'),
+        Sale.id.label('owner_id'),
+        Expense.id.label('item_id'),
+    ).join_from(Expense, Sale, Expense.sale_id == Sale.id) \
+        .join(ExpenseType, Expense.expense_type_id == ExpenseType.id) \
+        .where(Sale.date >= start, Sale.date < end, *sale_criteria)
+    general_expenses = select(
+        func.date(GeneralExpense.date),
+        ExpenseType.name,
+        GeneralExpense.amount,
+        GeneralExpense.description,
+        literal(False),
+        GeneralExpense.date,
+        literal(0),
+        GeneralExpense.id,
+    ).join(ExpenseType, GeneralExpense.expense_type_id == ExpenseType.id) \
+        .where(GeneralExpense.date >= start, GeneralExpense.date < end, *general_criteria)
+
+    # Внутри дня: сначала расходы продаж, затем общие, каждые по времени
+    timeline = union_all(sale_expenses, general_expenses).order_by(
+        desc(literal_column('day')), desc(literal_column('is_sale_expense')),
+        literal_column('moment'), literal_column('owner_id'), literal_column('item_id'))
+    rows = db.session.execute(timeline).all()
+    return [(day, list(items)) for day, items in groupby(rows, key=lambda row: row.day)]
+
+
+# Поддержка таблицы sales_rollup: при flush пересчитываются только затронутые ячейки (город, инвестор, месяц)
+def sales_rollup_key(city_id, investor_id, sale_date):
+    return city_id, investor_id, sale_date.year, sale_date.month
+
+
+def select_sales_rollup_keys(connection, sale_ids):
+    """Ключи sales_rollup для продаж по их текущему состоянию в базе"""
+    if not sale_ids:
+        return set()
+    rows = connection.execute(select(Sale.city_id, Sale.investor_id, Sale.date).where(Sale.id.in_(sale_ids)))
+    return {sales_rollup_key(*row) for row in rows if row.date is not None}
+
+
+def refresh_sales_rollup(connection, keys):
+    """Пересчитывает строки sales_rollup для ключей (город, инвестор, год, месяц) из таблиц sale и expense"""
+    rollup = SalesRollup.__table__
+    for city_id, investor_id, year, month in keys:
+        start = datetime(year, month, 1)
+        end = start + relativedelta(months=1)
+        connection.execute(rollup.delete().where(
+            rollup.c.city_id == city_id,
+            rollup.c.investor_id == investor_id,
+            rollup.c.year == year,
+            rollup.c.month == month
+        ))
+        totals = connection.execute(select(*sales_totals_columns()).where(
+            Sale.city_id == city_id,
+            Sale.investor_id == investor_id,
+            Sale.date >= start,
+            Sale.date < end
+        )).one()
+        if totals.count:
+            connection.execute(rollup.insert().values(
+                city_id=city_id,
+                investor_id=investor_id,
+                year=year,
+                month=month,
+                sales_count=totals.count,
+                total_buy=totals.total_buy,
+                total_sell=totals.gross_income,
+                total_expenses=totals.total_expenses
+            ))
+
+
+def rebuild_sales_rollup():
+    """Полностью пересобирает sales_rollup из таблиц sale и expense"""
+    year = cast(func.strftime('%Y', Sale.date), db.Integer)
+    month = cast(func.strftime('%m', Sale.date), db.Integer)
+    rows = select(Sale.city_id, Sale.investor_id, year, month, *sales_totals_columns()) \
+        .where(Sale.date.isnot(None)) \
+        .group_by(Sale.city_id, Sale.investor_id, year, month)
+    rollup = SalesRollup.__table__
+    with write_transaction():
+        db.session.execute(rollup.delete())
+        db.session.execute(rollup.insert().from_select(
+            ['city_id', 'investor_id', 'year', 'month', 'sales_count', 'total_sell', 'total_buy', 'total_expenses'],
+            rows
+        ))
+        bump_data_version('sales_rollup')
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_sales_rollup_changes(session, flush_context, instances):
+    """До flush запоминаем старые ключи изменяемых продаж — после flush их уже не прочитать"""
+    changed_sale_ids = set()
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Sale) and inspect(obj).identity:
+            changed_sale_ids.add(inspect(obj).identity[0])
+        elif isinstance(obj, Expense) and obj.sale_id:
+            changed_sale_ids.add(obj.sale_id)
+    pending = [obj for obj in list(session.new) + list(session.dirty)
+               if isinstance(obj, (Sale, Expense))]
+    if not changed_sale_ids and not pending:
+        return
+
+    session.info.setdefault('sales_rollup_keys', set()).update(
+        select_sales_rollup_keys(session.connection(), changed_sale_ids))
+    session.info.setdefault('sales_rollup_sale_ids', set()).update(changed_sale_ids)
+    session.info.setdefault('sales_rollup_pending', []).extend(pending)
+
+
+@event.listens_for(db.session, 'after_flush')
+def refresh_sales_rollup_after_flush(session, flush_context):
+    """После flush пересчитываем старые и новые ячейки sales_rollup в той же транзакции"""
+    keys = session.info.pop('sales_rollup_keys', set())
+    sale_ids = session.info.pop('sales_rollup_sale_ids', set())
+    for obj in session.info.pop('sales_rollup_pending', []):
+        sale_ids.add(obj.id if isinstance(obj, Sale) else obj.sale_id)
+    sale_ids.discard(None)
+    if not keys and not sale_ids:
+        return
+
+    connection = session.connection()
+    keys |= select_sales_rollup_keys(connection, sale_ids)
+    refresh_sales_rollup(connection, keys)
+    bump_data_version('sales_rollup', connection)
+
+
+# Годы с продажами для фильтров берутся из sales_rollup и кэшируются до следующей записи продаж
+# (в любом процессе — по версии 'sales_rollup')
+sale_years_cache = {'version': None, 'years': {}}
+
+
+def get_sale_years(investor_id=None):
+    """Годы с продажами по убыванию (для всех продаж или одного инвестора)"""
+    version = get_data_version('sales_rollup')
+    if sale_years_cache['version'] != version:
+        sale_years_cache['years'] = {}
+        sale_years_cache['version'] = version
+    years = sale_years_cache['years']
+    if investor_id not in years:
+        query = db.session.query(SalesRollup.year).distinct().order_by(SalesRollup.year.desc())
+        if investor_id is not None:
+            query = query.filter(SalesRollup.investor_id == investor_id)
+        years[investor_id] = [row.year for row in query]
+    return years[investor_id] or [date.today().year]
+
+
+MONTHS_RU = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
+             'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
+
+# Период отчета: [start, end), подпись и признак произвольного диапазона
+Period = namedtuple('Period', ['start', 'end', 'label', 'custom'])
+PeriodTotals = namedtuple('PeriodTotals', ['period', 'count', 'gross_income', 'total_buy', 'total_expenses',
+                                           'general_expenses', 'net_profit'])
+
+
+def parse_period(args):
+    """Период из параметров period_type/year/month/start_date/end_date (dashboard, stats, сравнение).
+    По умолчанию — текущий месяц"""
+    period_type = args.get('period_type', 'current_month')  # current_month, custom
+    year = args.get('year')
+    month = args.get('month')
+    start_date = args.get('start_date')
+    end_date = args.get('end_date')
+
+    # Неверная дата диапазона или месяц у границы календаря (9999-12) — 400, а не 500
+    try:
+        if period_type == 'custom' and start_date and end_date:
+            start = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end = datetime.strptime(end_date, '%Y-%m-%d').date()
+            end = end + relativedelta(days=1)  # чтобы включить конец дня
+        else:
+            today = date.today()
+            if year and month:
+                try:
+                    selected_date = date(int(year), int(month), 1)
+                except:
+                    selected_date = today
+            else:
+                selected_date = today
+            start = selected_date.replace(day=1)
+            end = start + relativedelta(months=1)
+    except (ValueError, OverflowError):
+        abort(400)
+
+    if period_type == 'custom':
+        label = f"{start.strftime('%d.%m.%Y')} — {(end - relativedelta(days=1)).strftime('%d.%m.%Y')}"
+    else:
+        label = f"{MONTHS_RU[start.month - 1]} {start.year}"
+    return Period(start, end, label, period_type == 'custom')
+
+
+def period_args(start, end=None):
+    """Параметры parse_period для месяца start или для диапазона [start, end)"""
+    if end is None:
+        return {'year': start.year, 'month': start.month}
+    return {'period_type': 'custom', 'start_date': start.isoformat(),
+            'end_date': (end - relativedelta(days=1)).isoformat()}
+
+
+def parse_compare_periods(args):
+    """Периоды для сравнения: ?period=2026-01 (месяц) или ?period=2026-01-05..2026-02-10 (диапазон),
+    можно несколько. Без них — выбранный период, предыдущий такой же и тот же год назад"""
+    # Даты у границ календаря (9999-12-31, 0001-01-01) переполняют соседний период — тоже 400
+    try:
+        return compare_periods(args)
+    except (ValueError, OverflowError):
+        abort(400)
+
+
+def compare_periods(args):
+    periods = []
+    for value in args.getlist('period'):
+        first, _, last = value.partition('..')
+        # Явный период проверяем сами: parse_period при неверном месяце молча берет текущий
+        if last:
+            start = datetime.strptime(first, '%Y-%m-%d').date()
+            end = datetime.strptime(last, '%Y-%m-%d').date()
+            if end < start:
+                raise ValueError(value)
+            periods.append(parse_period(period_args(start, end + relativedelta(days=1))))
+        else:
+            year, month = first.split('-')
+            periods.append(parse_period(period_args(date(int(year), int(month), 1))))
+    if periods:
+        return periods[:app.config['COMPARE_MAX_PERIODS']]
+
+    current = parse_period(args)
+    if current.custom:
+        length = current.end - current.start
+        previous = parse_period(period_args(current.start - length, current.start))
+        year_ago = parse_period(period_args(current.start - relativedelta(years=1),
+                                            current.end - relativedelta(years=1)))
+    else:
+        previous = parse_period(period_args(current.start - relativedelta(months=1)))
+        year_ago = parse_period(period_args(current.start - relativedelta(years=1)))
+    return [current, previous, year_ago]
+
+
+# Канонические фильтры отчетов для versioned_report: разные URL одного отчета дают один ключ кэша
+def period_report_args(args):
+    """Период parse_period: месяц — year/month, диапазон — period_type/start_date/end_date"""
+    period = parse_period(args)
+    return period_args(period.start, period.end if period.custom else None)
+
+
+def city_report_args(args):
+    city = args.get('city', 'all')
+    return {'city': city} if city != 'all' else {}
+
+
+def compare_report_args(args):
+    """Периоды сравнения (явные или по умолчанию) в виде ?period=2026-01 / ?period=2026-01-05..2026-02-10"""
+    values = []
+    for period in parse_compare_periods(args):
+        if period.custom:
+            values.append(f"{period.start.isoformat()}..{(period.end - relativedelta(days=1)).isoformat()}")
+        else:
+            values.append(f"{period.start.year:04d}-{period.start.month:02d}")
+    return {'period': values}
+
+
+def dashboard_report_args(args):
+    report_args = period_report_args(args)
+    if args.get('compare'):
+        report_args.update(compare_report_args(args), compare=1)
+    return report_args
+
+
+def stats_report_args(args):
+    return {**period_report_args(args), **city_report_args(args)}
+
+
+def compare_api_report_args(args):
+    return {**city_report_args(args), **compare_report_args(args)}
+
+
+def summary_report_args(args):
+    """Фильтры all_sales_summary: год, месяц (только вместе с годом) и город; неверные значения отбрасываются"""
+    report_args = city_report_args(args)
+    try:
+        year = int(args.get('year', 'all'))
+        date(year + 1, 1, 1)  # год целиком должен помещаться в календарь
+    except (ValueError, OverflowError):
+        return report_args
+    report_args['year'] = str(year)
+    try:
+        report_args['month'] = str(date(year, int(args.get('month', 'all')), 1).month)
+    except (ValueError, OverflowError):
+        pass
+    return report_args
+
+
+def rollup_period_criteria(start, end):
+    """Условия sales_rollup для месяцев в диапазоне [start, end) (границы — первые числа месяцев)"""
+    month_index = SalesRollup.year * 12 + SalesRollup.month
+    return (month_index >= start.year * 12 + start.month,
+            month_index < end.year * 12 + end.month)
+
+
+def rollup_city_criteria(city_name):
+    """Условие sales_rollup для города по его названию"""
+    return SalesRollup.city_id.in_(select(City.id).where(City.name == city_name))
+
+
+def get_rollup_totals(*criteria):
+    """Итоги продаж из sales_rollup (те же поля, что и у get_sales_totals)"""
+    return db.session.query(
+        func.coalesce(func.sum(SalesRollup.sales_count), 0).label('count'),
+        func.coalesce(func.sum(SalesRollup.total_sell), 0).label('gross_income'),
+        func.coalesce(func.sum(SalesRollup.total_buy), 0).label('total_buy'),
+        func.coalesce(func.sum(SalesRollup.total_expenses), 0).label('total_expenses'),
+    ).filter(*criteria).one()
+
+
+# Ключи сортировки списка продаж: (выражение, по убыванию).
+# Последний ключ всегда id, чтобы курсор однозначно указывал на строку.
+SALE_SORT_KEYS = {
+    'date_asc': [(Sale.date, False), (Sale.id, False)],
+    'date_desc': [(Sale.date, True), (Sale.id, True)],
+    'sell_desc': [(Sale.sell_price, True), (Sale.id, True)],
+    'sell_asc': [(Sale.sell_price, False), (Sale.id, False)],
+    'city': [(City.name, False), (Sale.id, False)],
+    'profit_desc': [(Sale.profit, True), (Sale.date, True), (Sale.id, True)],
+    'profit_asc': [(Sale.profit, False), (Sale.date, True), (Sale.id, True)],
+}
+
+
+def encode_cursor(values):
+    """Кодирует значения ключей сортировки последней строки в строку для URL"""
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def decode_cursor(cursor, keys):
+    """Разбирает курсор; при любой ошибке возвращает None (показываем первую страницу)"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if len(values) != len(keys):
+            return None
+        return [datetime.fromisoformat(v) if isinstance(column.type, db.DateTime) else v
+                for (column, _), v in zip(keys, values)]
+    except (ValueError, TypeError):
+        return None
+
+
+def keyset_after(keys, values):
+    """Условие "строка после курсора" для составного ключа с любыми направлениями"""
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        equal_prefix = [keys[j][0] == values[j] for j in range(i)]
+        clauses.append(and_(*equal_prefix, column < values[i] if descending else column > values[i]))
+    return or_(*clauses)
+
+
+def sale_order_by(keys):
+    return [column.desc() if descending else column.asc() for column, descending in keys]
+
+
+def group_sale_rows(rows):
+    """Строки "продажа LEFT JOIN expense", идущие подряд по продаже, -> (первая строка, SaleRow)"""
+    ref = get_reference_data()
+    for _, group in groupby(rows, key=lambda row: row.id):
+        group = list(group)
+        expenses = [ExpenseLine(ref.expense_type_names.get(row.expense_type_id), row.expense_amount)
+                    for row in group if row.expense_type_id is not None]
+        yield group[0], SaleRow(group[0], ref, expenses)
+
+
+def iter_sales(sales_query, sort):
+    """Все продажи запроса в порядке sort — генератор SaleRow для потоковой отрисовки.
+    Один SELECT с расходами, читается с курсора пачками: память не растет с числом продаж"""
+    keys = SALE_SORT_KEYS.get(sort, SALE_SORT_KEYS['date_desc'])
+    statement = sales_query.with_entities(*sale_row_columns(), Expense.expense_type_id,
+                                          Expense.amount.label('expense_amount')) \
+        .outerjoin(Expense, Expense.sale_id == Sale.id) \
+        .order_by(*sale_order_by(keys), Expense.id) \
+        .statement
+    rows = db.session.execute(statement, execution_options={'yield_per': app.config['STREAM_BATCH_SIZE']})
+    for _, sale in group_sale_rows(rows):
+        yield sale
+
+
+def paginate_sales(sales_query, sort, cursor):
+    """Keyset-пагинация списка продаж. Возвращает (SaleRow страницы, курсор следующей страницы).
+    Страница и ее расходы читаются одним запросом: подзапрос страницы LEFT JOIN expense"""
+    keys = SALE_SORT_KEYS.get(sort, SALE_SORT_KEYS['date_desc'])
+    per_page = app.config['SALES_PER_PAGE']
+
+    sales_query = sales_query.order_by(*sale_order_by(keys))
+    values = decode_cursor(cursor, keys) if cursor else None
+    if values:
+        sales_query = sales_query.filter(keyset_after(keys, values))
+
+    # Значения ключей берем из SQL, чтобы курсор точно совпадал с сортировкой в базе
+    page = sales_query.with_entities(*sale_row_columns(),
+                                     *[column.label(f'key_{i}') for i, (column, _) in enumerate(keys)]) \
+        .limit(per_page + 1) \
+        .subquery()
+    key_columns = [page.c[f'key_{i}'] for i in range(len(keys))]
+    statement = select(page, Expense.expense_type_id, Expense.amount.label('expense_amount')) \
+        .select_from(page.outerjoin(Expense, Expense.sale_id == page.c.id)) \
+        .order_by(*sale_order_by(zip(key_columns, (descending for _, descending in keys))), Expense.id)
+
+    rows = list(group_sale_rows(db.session.execute(statement)))  # не больше per_page + 1 продаж
+    sales = [sale for _, sale in rows[:per_page]]
+    next_cursor = None
+    if len(rows) > per_page:
+        # Курсор — ключи сортировки (последний из них — id) последней показанной продажи
+        last_row = rows[per_page - 1][0]
+        next_cursor = encode_cursor([getattr(last_row, f'key_{i}') for i in range(len(keys))])
+    return sales, next_cursor
+
+
+def page_url(cursor, show_all=False, **view_args):
+    """Ссылка на текущую страницу с теми же фильтрами и другим курсором (show_all — весь список сразу)"""
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('all', None)
+    if cursor:
+        args['after'] = cursor
+    if show_all:
+        args['all'] = 1
+    return url_for(request.endpoint, **view_args, **args)
+
+
+def stream_page(template_name, **context):
+    """Потоковый ответ: шапка и итоги уходят клиенту сразу, строки — по мере чтения из базы.
+    Мелкие куски Jinja склеиваются до STREAM_CHUNK_SIZE, чтобы не писать в сокет на каждую строку"""
+    stream = stream_template(template_name, **context)  # сам держит контекст запроса до конца потока
+
+    def chunks():
+        buffer = []
+        size = 0
+        for chunk in stream:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= app.config['STREAM_CHUNK_SIZE']:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield ''.join(buffer)
+    return app.response_class(chunks(), mimetype='text/html')
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
-@app.route('/uploads/<filename>')
+# Фото хранятся по SHA-256 содержимого: uploads/ab/abcd....jpg. Одинаковые фото хранятся один раз,
+# имя файла никогда не меняет содержимое, поэтому браузер может кэшировать его навсегда
+STORED_PHOTO_RE = re.compile(r'^[0-9a-f]{2}/([0-9a-f]{64})\.[a-z0-9]+$')
+
+
+def stored_photo_hash(filename):
+    """Хэш содержимого для фото из хранилища (None для старых файлов вида image.png)"""
+    match = STORED_PHOTO_RE.match(filename)
+    return match.group(1) if match else None
+
+
+# Сигнатуры (magic bytes) поддерживаемых форматов: тип определяется по содержимому, а не по имени файла
+PHOTO_SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+]
+
+
+def detect_photo_extension(header):
+    """Расширение по первым байтам файла или None, если это не поддерживаемое изображение"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for signature, extension in PHOTO_SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    return None
+
+
+# Принятые, но еще не перенесенные в хранилище фото: имя в базе -> временный файл
+pending_photo_uploads = {}
+pending_photo_uploads_lock = threading.Lock()
+
+
+def receive_photo(photo):
+    """Потоково принимает загрузку во временный файл, проверяя тип и считая SHA-256.
+    Возвращает имя для базы; сам файл переносится в хранилище в фоне после ответа (см. finish_received_photos)"""
+    header = photo.stream.read(16)
+    extension = detect_photo_extension(header)
+    if extension is None:
+        raise ValueError('Файл не является изображением JPEG, PNG, GIF, WebP или BMP')
+
+    os.makedirs(app.config['UPLOAD_TEMP_FOLDER'], exist_ok=True)
+    digest = hashlib.sha256(header)
+    fd, temp_path = tempfile.mkstemp(dir=app.config['UPLOAD_TEMP_FOLDER'], suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(header)
+            for chunk in iter(lambda: photo.stream.read(app.config['UPLOAD_CHUNK_SIZE']), b''):
+                digest.update(chunk)
+                temp_file.write(chunk)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    content_hash = digest.hexdigest()
+    filename = f'{content_hash[:2]}/{content_hash}.{extension}'
+    with pending_photo_uploads_lock:
+        pending_photo_uploads[filename] = temp_path
+    g.setdefault('received_photos', []).append((filename, temp_path))
+    return filename
+
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def persist_photo(filename, temp_path):
+    """Переносит принятый файл в хранилище (fsync + rename) и создает уменьшенные копии"""
+    try:
+        target = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if os.path.exists(target):
+            # Такое фото уже хранится; обновляем время изменения, чтобы cleanup_uploads.py
+            # не принял его за старый файл без ссылок, пока новая ссылка только появилась
+            os.remove(temp_path)
+            os.utime(target)
+        else:
+            with open(temp_path, 'rb') as temp_file:
+                os.fsync(temp_file.fileno())
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(temp_path, target)
+            fsync_directory(os.path.dirname(target))
+    except Exception:
+        app.logger.exception('Не удалось сохранить фото %s', filename)
+        return
+    finally:
+        with pending_photo_uploads_lock:
+            if pending_photo_uploads.get(filename) == temp_path:
+                del pending_photo_uploads[filename]
+    if Image is not None:
+        run_photo_variants(filename)
+
+
+def discard_photo(filename, temp_path):
+    with pending_photo_uploads_lock:
+        if pending_photo_uploads.get(filename) == temp_path:
+            del pending_photo_uploads[filename]
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+
+@app.teardown_request
+def finish_received_photos(error=None):
+    """После ответа: фото успешного запроса уходят в фоновый перенос, фото упавшего — удаляются"""
+    for filename, temp_path in g.pop('received_photos', []):
+        if error is None:
+            photo_executor.submit(persist_photo, filename, temp_path)
+        else:
+            discard_photo(filename, temp_path)
+
+
+def send_photo(directory, filename, content_hash):
+    """Отдает файл; файлы из хранилища по хэшу — с immutable-кэшем и ETag из хэша"""
+    if content_hash is None:
+        return send_from_directory(directory, filename)
+    response = send_from_directory(directory, filename, etag=content_hash,
+                                   max_age=app.config['PHOTO_CACHE_MAX_AGE'])
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Фото, которое еще переносится в хранилище этим воркером, отдаем из временного файла без кэша
+    with pending_photo_uploads_lock:
+        temp_path = pending_photo_uploads.get(filename)
+    if temp_path and os.path.exists(temp_path):
+        return send_file(os.path.abspath(temp_path), mimetype=mimetypes.guess_type(filename)[0])
+    return send_photo(app.config['UPLOAD_FOLDER'], filename, stored_photo_hash(filename))
+
+
+# Перенос загрузок в хранилище и уменьшенные копии фото выполняются в фоновых потоках,
+# чтобы не задерживать ответ на сохранение формы
+photo_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='photos')
+pending_photo_variants = set()
+pending_photo_variants_lock = threading.Lock()
+
+
+def photo_variant_name(filename, variant):
+    """Путь копии относительно PHOTO_VARIANTS_FOLDER (расширение оригинала сохраняется в имени)"""
+    return f'{variant}/{filename}.webp'
+
+
+def generate_photo_variants(filename):
+    """Создает WebP-копии фото во всех размерах из PHOTO_VARIANTS"""
+    source = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+        for variant, size in app.config['PHOTO_VARIANTS'].items():
+            target = os.path.join(app.config['PHOTO_VARIANTS_FOLDER'], photo_variant_name(filename, variant))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            # Пишем во временный файл и переименовываем, чтобы не отдать недописанную копию
+            temp_path = f'{target}.{threading.get_ident()}.tmp'
+            resized.save(temp_path, 'WEBP', quality=app.config['PHOTO_WEBP_QUALITY'], method=4)
+            os.replace(temp_path, target)
+
+
+def run_photo_variants(filename):
+    try:
+        generate_photo_variants(filename)
+    except Exception:
+        app.logger.exception('Не удалось создать копии фото %s', filename)
+    finally:
+        with pending_photo_variants_lock:
+            pending_photo_variants.discard(filename)
+
+
+def schedule_photo_variants(filename):
+    """Ставит создание копий в очередь фонового потока (повторная постановка игнорируется)"""
+    if Image is None or not filename:
+        return
+    with pending_photo_variants_lock:
+        if filename in pending_photo_variants:
+            return
+        pending_photo_variants.add(filename)
+    photo_executor.submit(run_photo_variants, filename)
+
+
+@app.route('/uploads/variants/<variant>/<path:filename>')
+def uploaded_photo(variant, filename):
+    """Фото в размере variant; пока копия не готова (или нет Pillow) — оригинал"""
+    if variant not in app.config['PHOTO_VARIANTS']:
+        abort(404)
+    variant_name = photo_variant_name(filename, variant)
+    if os.path.isfile(safe_join(app.config['PHOTO_VARIANTS_FOLDER'], variant_name) or ''):
+        content_hash = stored_photo_hash(filename)
+        return send_photo(app.config['PHOTO_VARIANTS_FOLDER'], variant_name,
+                          content_hash and f'{variant}-{content_hash}')
+    # Старые загрузки получают копии при первом обращении.
+    # Оригинал под адресом копии отдается без immutable, чтобы браузер потом получил копию
+    if os.path.isfile(safe_join(app.config['UPLOAD_FOLDER'], filename) or ''):
+        schedule_photo_variants(filename)
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return uploaded_file(filename)
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    flash(f'Файл слишком большой (максимум {limit_mb} МБ).', 'error')
+    return redirect(request.referrer or url_for('main'))
 
 
 # ГЛАВНАЯ СТРАНИЦА (MAIN) - корневой маршрут
@@ -146,129 +1378,92 @@ def main():
 
 # СТРАНИЦА СТОКА
 @app.route('/stock')
+@versioned_report('stock_item')
 def stock():
     # Подсчитываем данные из таблицы StockItem (только непроданные)
-    all_stock_items = StockItem.query.filter_by(sold=False).all()
-    total_invested = sum(item.total_invested for item in all_stock_items)
-    stock_positions = sum(item.quantity for item in all_stock_items)
-    expected_profit = sum(item.expected_profit for item in all_stock_items)
+    totals = get_stock_totals()
     
     return render_template('stock.html',
-                           total_invested=total_invested,
-                           stock_positions=stock_positions,
-                           expected_profit=expected_profit)
+                           total_invested=totals.invested,
+                           stock_positions=totals.positions,
+                           expected_profit=totals.expected_profit)
 
 
 # СТРАНИЦА "ВСЕ ГОРОДА" ДЛЯ СТОКА
 @app.route('/stock_cities')
+@versioned_report('stock_item', 'reference')
 def stock_cities():
-    # Получаем все города, у которых есть сток
-    cities = City.query.all()
-    cities_data = {}
-    
-    for city in cities:
-        # Фильтруем только непроданные позиции (sold=False или sold IS NULL для старых записей)
-        stock_items = StockItem.query.filter(
-            StockItem.city_id == city.id,
-            or_(StockItem.sold == False, StockItem.sold.is_(None))
-        ).all()
-        if stock_items:  # Показываем только города с стоком
-            total_invested = sum(item.total_invested for item in stock_items)
-            stock_positions = sum(item.quantity for item in stock_items)
-            expected_profit = sum(item.expected_profit for item in stock_items)
-            
-            cities_data[city.name] = {
-                'positions': stock_positions,
-                'invested': total_invested,
-                'expected_profit': expected_profit
-            }
-    
-    # Сортируем города по названию
-    sorted_cities = sorted(cities_data.items())
+    # Один GROUP BY по городам вместо отдельного запроса на каждый город
+    cities_data = get_stock_totals_by_city()
     
-    return render_template('stock_cities.html', cities_data=dict(sorted_cities))
+    return render_template('stock_cities.html', cities_data=cities_data)
 
 
 # СТРАНИЦА ДЕТАЛЬНОГО СТОКА ПО ГОРОДУ
 @app.route('/stock_city/<city_name>')
 def stock_city_detail(city_name):
     # Находим город
-    city = City.query.filter_by(name=city_name).first_or_404()
+    ref = get_reference_data()
+    if city_name not in ref.city_ids:
+        abort(404)
+    city = RefItem(ref.city_ids[city_name], city_name)
     
     # Получаем все товары в стоке для этого города (только непроданные)
-    stock_items = StockItem.query.filter_by(city_id=city.id, sold=False).all()
+    stock_items = active_stock_rows(StockItem.city_id == city.id)
     
-    # Подсчитываем общую статистику
-    total_invested = sum(item.total_invested for item in stock_items)
-    stock_positions = sum(item.quantity for item in stock_items)
-    expected_profit = sum(item.expected_profit for item in stock_items)
+    # Подсчитываем общую статистику в SQL
+    totals = get_stock_totals(StockItem.city_id == city.id)
     
-    return render_template('stock_city_detail.html',
-                           city=city,
-                           stock_items=stock_items,
-                           total_invested=total_invested,
-                           stock_positions=stock_positions,
-                           expected_profit=expected_profit)
+    # Позиции отдаются потоком: страница не собирается целиком в памяти
+    return stream_page('stock_city_detail.html',
+                       city=city,
+                       stock_items=stock_items,
+                       total_invested=totals.invested,
+                       stock_positions=totals.positions,
+                       expected_profit=totals.expected_profit)
 
 
 # СТРАНИЦА "ВСЕ ИНВЕСТОРЫ" ДЛЯ СТОКА
 @app.route('/stock_investors')
 def stock_investors():
-    # Получаем всех инвесторов, у которых есть сток
-    investors = Investor.query.all()
-    investors_data = {}
-    
-    for investor in investors:
-        stock_items = StockItem.query.filter_by(investor_id=investor.id, sold=False).all()
-        if stock_items:  # Показываем только инвесторов с стоком
-            total_invested = sum(item.total_invested for item in stock_items)
-            stock_positions = sum(item.quantity for item in stock_items)
-            expected_profit = sum(item.expected_profit for item in stock_items)
-            
-            # Получаем список уникальных городов для этого инвестора
-            cities = sorted(set([item.city.name for item in stock_items]))
-            cities_str = ', '.join(cities)
-            
-            investors_data[investor.name] = {
-                'positions': stock_positions,
-                'invested': total_invested,
-                'expected_profit': expected_profit,
-                'cities': cities_str
-            }
+    # Один GROUP BY по инвесторам, города собираются через GROUP_CONCAT
+    investors_data = get_stock_totals_by_investor()
     
-    # Сортируем инвесторов по названию
-    sorted_investors = sorted(investors_data.items())
-    
-    return render_template('stock_investors.html', investors_data=dict(sorted_investors))
+    return render_template('stock_investors.html', investors_data=investors_data)
 
 
 # СТРАНИЦА ДЕТАЛЬНОГО СТОКА ПО ИНВЕСТОРУ
 @app.route('/stock_investor/<investor_name>')
 def stock_investor_detail(investor_name):
     # Находим инвестора
-    investor = Investor.query.filter_by(name=investor_name).first_or_404()
+    ref = get_reference_data()
+    if investor_name not in ref.investor_ids:
+        abort(404)
+    investor = RefItem(ref.investor_ids[investor_name], investor_name)
     
     # Получаем все товары в стоке для этого инвестора (только непроданные)
-    stock_items = StockItem.query.filter_by(investor_id=investor.id, sold=False).all()
+    stock_items = active_stock_rows(StockItem.investor_id == investor.id)
     
-    # Подсчитываем общую статистику
-    total_invested = sum(item.total_invested for item in stock_items)
-    stock_positions = sum(item.quantity for item in stock_items)
-    expected_profit = sum(item.expected_profit for item in stock_items)
+    # Подсчитываем общую статистику в SQL
+    totals = get_stock_totals(StockItem.investor_id == investor.id)
     
-    return render_template('stock_investor_detail.html',
-                           investor=investor,
-                           stock_items=stock_items,
-                           total_invested=total_invested,
-                           stock_positions=stock_positions,
-                           expected_profit=expected_profit)
+    # Позиции отдаются потоком: страница не собирается целиком в памяти
+    return stream_page('stock_investor_detail.html',
+                       investor=investor,
+                       stock_items=stock_items,
+                       total_invested=totals.invested,
+                       stock_positions=totals.positions,
+                       expected_profit=totals.expected_profit)
 
 
 # СТРАНИЦА ИСТОРИИ ПРОДАЖ ПО ИНВЕСТОРУ
 @app.route('/investor_sales_history/<investor_name>')
 def investor_sales_history(investor_name):
     # Находим инвестора
-    investor = Investor.query.filter_by(name=investor_name).first_or_404()
+    ref = get_reference_data()
+    if investor_name not in ref.investor_ids:
+        abort(404)
+    investor = RefItem(ref.investor_ids[investor_name], investor_name)
     
     # Параметры из запроса
     sort = request.args.get('sort', 'date_desc')
@@ -305,123 +1500,115 @@ def investor_sales_history(investor_name):
         except:
             pass
     
-    # Сортировка
-    if sort == 'date_asc':
-        sales_query = sales_query.order_by(Sale.date.asc())
-    elif sort == 'date_desc':
-        sales_query = sales_query.order_by(Sale.date.desc())
-    elif sort == 'sell_desc':
-        sales_query = sales_query.order_by(Sale.sell_price.desc())
-    elif sort == 'sell_asc':
-        sales_query = sales_query.order_by(Sale.sell_price.asc())
-    else:
-        sales_query = sales_query.order_by(Sale.date.desc())
-    
-    sales = sales_query.all()
+    if sort == 'city':
+        sales_query = sales_query.join(City)
     
-    # Сортировка по прибыли в Python
-    if sort == 'profit_desc':
-        sales.sort(key=lambda s: s.profit, reverse=True)
-    elif sort == 'profit_asc':
-        sales.sort(key=lambda s: s.profit)
-    
-    # Статистика
-    total_realized = sum(s.sell_price for s in sales)  # Сумма реализованных позиций
-    count_sales = len(sales)  # Количество реализованных позиций
-    gross_income = sum(s.sell_price for s in sales)  # Доход
-    total_expenses = sum(sum(e.amount for e in s.expenses) for s in sales)  # Расходы
-    total_buy = sum(s.buy_price for s in sales)  # Сумма покупок
+    # Статистика по всем продажам фильтра (агрегатом, не по странице)
+    totals = get_sales_totals(sales_query)
+    total_realized = totals.gross_income  # Сумма реализованных позиций
+    count_sales = totals.count  # Количество реализованных позиций
+    gross_income = totals.gross_income  # Доход
+    total_expenses = totals.total_expenses  # Расходы
+    total_buy = totals.total_buy  # Сумма покупок
     net_profit = gross_income - total_buy - total_expenses  # Прибыль с вычетом расходов
     
-    # Список всех годов для фильтра
-    all_years = sorted(set(s.date.year for s in Sale.query.filter(Sale.investor_id == investor.id).with_entities(Sale.date).all()), reverse=True)
-    if not all_years:
-        all_years = [date.today().year]
+    # Сортировка и keyset-пагинация; ?all=1 — вся история одной страницей, потоком
+    show_all = request.args.get('all') == '1'
+    if show_all:
+        sales, next_cursor = iter_sales(sales_query, sort), None
+    else:
+        sales, next_cursor = paginate_sales(sales_query, sort, request.args.get('after'))
     
-    # Месяцы для фильтра
-    months_ru = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
-                 'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
+    # Список всех годов для фильтра
+    all_years = get_sale_years(investor.id)
     
-    return render_template('investor_sales_history.html',
-                           investor=investor,
-                           sales=sales,
-                           total_realized=round(total_realized, 2),
-                           count_sales=count_sales,
-                           gross_income=round(gross_income, 2),
-                           total_expenses=round(total_expenses, 2),
-                           net_profit=round(net_profit, 2),
-                           sort=sort,
-                           year_filter=year_filter if year_filter != 'all' else 'all',
-                           month_filter=month_filter if month_filter != 'all' else 'all',
-                           period_filter=period_filter,
-                           all_years=all_years,
-                           months_ru=months_ru)
+    render = stream_page if show_all else render_template
+    return render('investor_sales_history.html',
+                  investor=investor,
+                  sales=sales,
+                  total_realized=round(total_realized, 2),
+                  count_sales=count_sales,
+                  gross_income=round(gross_income, 2),
+                  total_expenses=round(total_expenses, 2),
+                  net_profit=round(net_profit, 2),
+                  sort=sort,
+                  year_filter=year_filter if year_filter != 'all' else 'all',
+                  month_filter=month_filter if month_filter != 'all' else 'all',
+                  period_filter=period_filter,
+                  all_years=all_years,
+                  months_ru=MONTHS_RU,
+                  next_page_url=page_url(next_cursor, investor_name=investor.name) if next_cursor else None,
+                  all_page_url=page_url(None, show_all=True, investor_name=investor.name) if next_cursor else None,
+                  first_page_url=page_url(None, investor_name=investor.name) if request.args.get('after') and not show_all else None)
 
 
 # СТРАНИЦА DASHBOARD (старая главная)
 @app.route('/dashboard', methods=['GET', 'POST'])
+@versioned_report('sale', 'expense', 'general_expense', 'sales_rollup', 'reference', filters=dashboard_report_args)
 def dashboard():
-    # Получаем параметры периода
-    period_type = request.args.get('period_type', 'current_month')  # current_month, custom
-    year = request.args.get('year')
-    month = request.args.get('month')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-
-    # Определяем даты фильтра
-    if period_type == 'custom' and start_date and end_date:
-        start = datetime.strptime(start_date, '%Y-%m-%d').date()
-        end = datetime.strptime(end_date, '%Y-%m-%d').date()
-        end = end + relativedelta(days=1)  # чтобы включить конец дня
-    else:
-        # По умолчанию — текущий месяц
-        today = date.today()
-        if year and month:
-            try:
-                selected_date = date(int(year), int(month), 1)
-            except:
-                selected_date = today
-        else:
-            selected_date = today
+    period = parse_period(request.args)
+    period_type = 'custom' if period.custom else 'current_month'
+    start, end = period.start, period.end
 
-        start = selected_date.replace(day=1)
-        end = (start + relativedelta(months=1))
+    # Режим сравнения (?compare=1): выбранный период, предыдущий и год назад — одним запросом
+    comparison = get_period_totals(parse_compare_periods(request.args)) if request.args.get('compare') else None
 
-    # Фильтруем продажи за период
-    sales = Sale.query.filter(Sale.date >= start, Sale.date < end).all()
+    # Только агрегаты, без загрузки строк: итоги продаж (целые месяцы — из sales_rollup,
+    # произвольный диапазон — агрегатом по продажам) и сумма общих расходов
+    if period_type == 'custom':
+        totals = get_sales_totals(Sale.query.filter(Sale.date >= start, Sale.date < end))
+    else:
+        totals = get_rollup_totals(*rollup_period_criteria(start, end))
 
     # Расчёты для dashboard
-    count_sales = len(sales)
-    gross_income = sum(s.sell_price for s in sales)  # Грязный доход
-    total_buy = sum(s.buy_price for s in sales)
-    total_sale_expenses = sum(sum(e.amount for e in s.expenses) for s in sales)
-    general_expenses = GeneralExpense.query.filter(GeneralExpense.date >= start, GeneralExpense.date < end).all()
-    total_general_expenses = sum(g.amount for g in general_expenses)
+    count_sales = totals.count
+    gross_income = totals.gross_income  # Грязный доход
+    total_buy = totals.total_buy
+    total_sale_expenses = totals.total_expenses
+    total_general_expenses = get_general_expenses_total(start, end)
     net_profit = gross_income - total_buy - total_sale_expenses - total_general_expenses
 
-    # Для отображения периода
-    months_ru = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
-                 'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
-    month_name = months_ru[start.month - 1]
-    if period_type == 'custom':
-        period_label = f"{start.strftime('%d.%m.%Y')} — {(end - relativedelta(days=1)).strftime('%d.%m.%Y')}"
-    else:
-        period_label = f"{month_name} {start.year}"
-
     # Список годов для выбора
-    all_years = sorted(set(s.date.year for s in Sale.query.with_entities(Sale.date).all()), reverse=True)
-    if not all_years:
-        all_years = [date.today().year]
+    all_years = get_sale_years()
 
     return render_template('dashboard.html',
                            count_sales=count_sales,
                            gross_income=round(gross_income, 2),
                            net_profit=round(net_profit, 2),
-                           period_label=period_label,
+                           comparison=comparison,
+                           period_label=period.label,
                            all_years=all_years,
                            selected_year=start.year,
                            selected_month=start.month,
-                           period_type=period_type)
+                           period_type=period_type,
+                           report_args=g.report_args)
+
+
+@app.route('/api/dashboard/compare')
+@versioned_report('sale', 'expense', 'general_expense', 'reference', filters=compare_api_report_args,
+                  mimetype='application/json')
+def dashboard_compare():
+    """KPI dashboard для нескольких периодов (?period=2026-01&period=2025-12 ...) одним запросом"""
+    city_filter = request.args.get('city', 'all')
+    sale_criteria = []
+    general_criteria = []
+    if city_filter != 'all':
+        city_id = get_reference_data().city_ids.get(city_filter)
+        sale_criteria.append(Sale.city_id == city_id)
+        general_criteria.append(GeneralExpense.city_id == city_id)
+
+    totals = get_period_totals(parse_compare_periods(request.args), sale_criteria, general_criteria)
+    return jsonify({'periods': [{
+        'label': item.period.label,
+        'start': item.period.start.isoformat(),
+        'end': (item.period.end - relativedelta(days=1)).isoformat(),
+        'count': item.count,
+        'gross_income': round(item.gross_income, 2),
+        'total_buy': round(item.total_buy, 2),
+        'sale_expenses': round(item.total_expenses, 2),
+        'general_expenses': round(item.general_expenses, 2),
+        'net_profit': round(item.net_profit, 2),
+    } for item in totals]})
 
 
 # СТАРАЯ СТРАНИЦА СО СПИСКОМ ПРОДАЖ — теперь на /sales
@@ -436,9 +1623,15 @@ def sales():
     # Базовый запрос
     sales_query = Sale.query
 
-    # Фильтр по городу
+    # Те же фильтры для итогов из sales_rollup
+    rollup_criteria = []
+
+    # Фильтр по городу (город присоединяем один раз — он нужен и для сортировки по городу)
+    if city_filter != 'all' or sort == 'city':
+        sales_query = sales_query.join(City)
     if city_filter != 'all':
-        sales_query = sales_query.join(City).filter(City.name == city_filter)
+        sales_query = sales_query.filter(City.name == city_filter)
+        rollup_criteria.append(rollup_city_criteria(city_filter))
 
     # Фильтр по году и месяцу
     if year_filter != 'all':
@@ -450,41 +1643,23 @@ def sales():
                     start_date = date(year_int, month_int, 1)
                     end_date = start_date + relativedelta(months=1)
                     sales_query = sales_query.filter(Sale.date >= start_date, Sale.date < end_date)
+                    rollup_criteria.extend(rollup_period_criteria(start_date, end_date))
                 except:
                     start_date = date(year_int, 1, 1)
                     end_date = date(year_int + 1, 1, 1)
                     sales_query = sales_query.filter(Sale.date >= start_date, Sale.date < end_date)
+                    rollup_criteria.extend(rollup_period_criteria(start_date, end_date))
             else:
                 start_date = date(year_int, 1, 1)
                 end_date = date(year_int + 1, 1, 1)
                 sales_query = sales_query.filter(Sale.date >= start_date, Sale.date < end_date)
+                rollup_criteria.extend(rollup_period_criteria(start_date, end_date))
         except:
             pass
 
-    # Сортировка
-    if sort == 'date_asc':
-        sales_query = sales_query.order_by(Sale.date.asc())
-    elif sort == 'date_desc':
-        sales_query = sales_query.order_by(Sale.date.desc())
-    elif sort == 'sell_desc':
-        sales_query = sales_query.order_by(Sale.sell_price.desc())
-    elif sort == 'sell_asc':
-        sales_query = sales_query.order_by(Sale.sell_price.asc())
-    elif sort == 'city':
-        sales_query = sales_query.join(City).order_by(City.name.asc())
-    else:
-        sales_query = sales_query.order_by(Sale.date.desc())
-
-    sales = sales_query.all()
-
-    # Сортировка по прибыли в Python
-    if sort == 'profit_desc':
-        sales.sort(key=lambda s: s.profit, reverse=True)
-    elif sort == 'profit_asc':
-        sales.sort(key=lambda s: s.profit)
-
-    # Общая прибыль (учитываем фильтр)
-    total_profit = sum(s.profit for s in sales)
+    # Общая прибыль (учитываем фильтр) — из sales_rollup по всему набору
+    totals = get_rollup_totals(*rollup_criteria)
+    total_profit = totals.gross_income - totals.total_buy - totals.total_expenses
     
     # Расчет общих расходов за выбранный период
     if year_filter != 'all' and month_filter != 'all':
@@ -503,146 +1678,159 @@ def sales():
         end_month = start_month + relativedelta(months=1)
     
     # Расходы из продаж за текущий месяц
-    # Приводим дату к типу date для корректного сравнения
-    def get_sale_date(sale):
-        return sale.date.date() if isinstance(sale.date, datetime) else sale.date
-    
-    sales_this_month = [s for s in sales if start_month <= get_sale_date(s) < end_month]
-    total_sale_expenses = sum(sum(e.amount for e in s.expenses) for s in sales_this_month)
+    month_totals = get_rollup_totals(*rollup_criteria, *rollup_period_criteria(start_month, end_month))
+    total_sale_expenses = month_totals.total_expenses
     
     # Общие расходы за текущий месяц
     general_expenses_query = GeneralExpense.query.filter(GeneralExpense.date >= start_month, GeneralExpense.date < end_month)
     if city_filter != 'all':
-        city_obj = City.query.filter_by(name=city_filter).first()
-        if city_obj:
-            general_expenses_query = general_expenses_query.filter(GeneralExpense.city_id == city_obj.id)
+        city_id = get_reference_data().city_ids.get(city_filter)
+        if city_id:
+            general_expenses_query = general_expenses_query.filter(GeneralExpense.city_id == city_id)
     general_expenses = general_expenses_query.all()
     total_general_expenses = sum(g.amount for g in general_expenses)
     
     total_expenses = total_sale_expenses + total_general_expenses
     
     # Дополнительные метрики
-    count_sales = len(sales_this_month)
-    gross_income = sum(s.sell_price for s in sales_this_month)
-    total_buy = sum(s.buy_price for s in sales_this_month)
+    count_sales = month_totals.count
+    gross_income = month_totals.gross_income
+    total_buy = month_totals.total_buy
     net_profit_month = gross_income - total_buy - total_expenses
     
     # Период для отображения
-    months_ru = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
-                 'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
-    month_name = months_ru[start_month.month - 1]
+    month_name = MONTHS_RU[start_month.month - 1]
     period_label = f"{month_name} {start_month.year}"
 
+    # Сортировка и keyset-пагинация; ?all=1 — все продажи одной страницей, потоком
+    show_all = request.args.get('all') == '1'
+    if show_all:
+        sales, next_cursor = iter_sales(sales_query, sort), None
+    else:
+        sales, next_cursor = paginate_sales(sales_query, sort, request.args.get('after'))
+
     # Список всех уникальных городов для фильтра
-    all_cities = sorted([c.name for c in City.query.all()])
+    all_cities = sorted(get_reference_data().city_ids)
     
     # Список всех годов для фильтра
-    all_years = sorted(set(s.date.year for s in Sale.query.with_entities(Sale.date).all()), reverse=True)
-    if not all_years:
-        all_years = [date.today().year]
-
-    return render_template('index.html',
-                           sales=sales,
-                           total_profit=round(total_profit, 2),
-                           sort=sort,
-                           city_filter=city_filter,
-                           year_filter=year_filter if year_filter != 'all' else 'all',
-                           month_filter=month_filter if month_filter != 'all' else 'all',
-                           all_cities=all_cities,
-                           all_years=all_years,
-                           months_ru=months_ru,
-                           total_expenses=round(total_expenses, 2),
-                           count_sales=count_sales,
-                           gross_income=round(gross_income, 2),
-                           net_profit_month=round(net_profit_month, 2),
-                           period_label=period_label)
+    all_years = get_sale_years()
+
+    render = stream_page if show_all else render_template
+    return render('index.html',
+                  sales=sales,
+                  total_profit=round(total_profit, 2),
+                  sort=sort,
+                  city_filter=city_filter,
+                  year_filter=year_filter if year_filter != 'all' else 'all',
+                  month_filter=month_filter if month_filter != 'all' else 'all',
+                  all_cities=all_cities,
+                  all_years=all_years,
+                  months_ru=MONTHS_RU,
+                  total_expenses=round(total_expenses, 2),
+                  count_sales=count_sales,
+                  gross_income=round(gross_income, 2),
+                  net_profit_month=round(net_profit_month, 2),
+                  period_label=period_label,
+                  next_page_url=page_url(next_cursor) if next_cursor else None,
+                  all_page_url=page_url(None, show_all=True) if next_cursor else None,
+                  first_page_url=page_url(None) if request.args.get('after') and not show_all else None)
+
+
+def create_sale(fields, expense_lines, stock_id=None):
+    """Создает продажу с расходами одним flush и одним commit. Продажа из стока: сток помечается
+    проданным условным UPDATE ... WHERE sold = 0, его расходы (и фото, если своего нет) переносятся
+    в продажу. Если сток не найден или уже продан — ValueError, ничего не сохраняется"""
+    with write_transaction():
+        expenses = [Expense(expense_type_id=expense_type_id, amount=amount, comment=comment)
+                    for expense_type_id, amount, comment in expense_lines]
+        if stock_id:
+            # Запись уже сериализована (BEGIN IMMEDIATE), поэтому из двух одновременных отправок формы
+            # сток достанется одной, вторая получит 0 строк
+            stock_item = db.session.execute(
+                update(StockItem)
+                .where(StockItem.id == stock_id, StockItem.sold == false())
+                .values(sold=True)
+                .returning(StockItem.photo),
+                execution_options={'synchronize_session': False}
+            ).first()
+            if stock_item is None:
+                raise ValueError('Сток не найден или уже продан')
+            bump_data_version(VERSIONED_MODELS[StockItem])  # UPDATE в обход ORM не вызывает before_flush
+
+            stock_expenses = db.session.query(StockExpense.expense_type_id, StockExpense.amount,
+                                              StockExpense.comment) \
+                .filter(StockExpense.stock_item_id == stock_id).order_by(StockExpense.id)
+            expenses[:0] = [Expense(expense_type_id=row.expense_type_id, amount=row.amount, comment=row.comment)
+                            for row in stock_expenses]
+            if not fields.get('photo'):
+                fields = dict(fields, photo=stock_item.photo)
+
+        sale = Sale(expenses=expenses, **fields)
+        db.session.add(sale)
+    return sale
 
 
 @app.route('/add_sale', methods=['GET', 'POST'])
 def add_sale():
-    cities = City.query.all()
-    expense_types = ExpenseType.query.all()
-    employees = Employee.query.all()
-    investors = Investor.query.all()
-    
-    # Получаем stock_id из параметров запроса (если переходим из стока)
-    stock_id = request.args.get('stock_id', type=int)
-    stock_item = None
-    if stock_id:
-        stock_item = StockItem.query.get(stock_id)
-        if not stock_item:
-            flash('Сток не найден!', 'error')
-            return redirect(url_for('stock'))
-
     if request.method == 'POST':
-        product_name = request.form['product_name']
-        reference = request.form.get('reference', '')
-        buy_price = float(request.form['buy_price'])
-        sell_price = float(request.form['sell_price'])
-        city_id = int(request.form['city_id'])
-        employee_id = int(request.form['employee_id'])
-        investor_id = int(request.form.get('investor_id')) if request.form.get('investor_id') else None
-        date_str = request.form['date']
-        date = datetime.strptime(date_str, '%Y-%m-%d') if date_str else datetime.utcnow()
-        
-        # Получаем stock_id из скрытого поля формы (если продажа из стока)
-        stock_id_from_form = request.form.get('stock_id', type=int)
-
+        # Файл принимаем до транзакции, чтобы не держать блокировку записи на время загрузки
         photo_path = None
         photo = request.files['photo']
         if photo and allowed_file(photo.filename):
-            filename = secure_filename(photo.filename)
-            photo_path = filename
-            photo.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        elif stock_id_from_form:
-            # Если фото не загружено, но есть сток, используем фото из стока
-            stock_item_for_sale = StockItem.query.get(stock_id_from_form)
-            if stock_item_for_sale and stock_item_for_sale.photo:
-                photo_path = stock_item_for_sale.photo
-
-        new_sale = Sale(photo=photo_path, product_name=product_name, reference=reference,
-                        buy_price=buy_price, sell_price=sell_price,
-                        city_id=city_id, employee_id=employee_id, investor_id=investor_id, date=date)
-        db.session.add(new_sale)
-        db.session.commit()
-
-        # Если продажа создана из стока, переносим расходы из стока
-        if stock_id_from_form:
-            stock_item_for_sale = StockItem.query.get(stock_id_from_form)
-            if stock_item_for_sale:
-                # Переносим расходы из стока в продажу
-                for stock_expense in stock_item_for_sale.expenses:
-                    sale_expense = Expense(
-                        sale_id=new_sale.id,
-                        expense_type_id=stock_expense.expense_type_id,
-                        amount=stock_expense.amount,
-                        comment=stock_expense.comment
-                    )
-                    db.session.add(sale_expense)
-        
-        # Добавление расходов из формы (могут быть дополнительные расходы или расходы для обычной продажи)
-        expense_type_ids = request.form.getlist('expense_type_id')
-        amounts = request.form.getlist('expense_amount')
-        comments = request.form.getlist('expense_comment')
-        for et_id, amt, comment in zip(expense_type_ids, amounts, comments):
-            if et_id and amt:
-                expense = Expense(sale_id=new_sale.id, expense_type_id=int(et_id), amount=float(amt), comment=comment if comment else None)
-                db.session.add(expense)
-        
-        # Если продажа создана из стока, помечаем сток как проданный
-        if stock_id_from_form:
-            stock_item_for_sale = StockItem.query.get(stock_id_from_form)
-            if stock_item_for_sale:
-                stock_item_for_sale.sold = True
-        
-        db.session.commit()
-        if stock_id_from_form:
+            try:
+                photo_path = receive_photo(photo)
+            except ValueError as e:
+                flash(str(e), 'error')
+                return redirect(request.url)
+
+        date_str = request.form['date']
+        fields = {
+            'photo': photo_path,
+            'product_name': request.form['product_name'],
+            'reference': request.form.get('reference', ''),
+            'buy_price': float(request.form['buy_price']),
+            'sell_price': float(request.form['sell_price']),
+            'city_id': int(request.form['city_id']),
+            'employee_id': int(request.form['employee_id']),
+            'investor_id': int(request.form.get('investor_id')) if request.form.get('investor_id') else None,
+            'date': datetime.strptime(date_str, '%Y-%m-%d') if date_str else datetime.utcnow(),
+        }
+        # Расходы из формы (дополнительные к расходам стока или расходы обычной продажи)
+        expense_lines = [(int(et_id), float(amt), comment or None)
+                         for et_id, amt, comment in zip(request.form.getlist('expense_type_id'),
+                                                        request.form.getlist('expense_amount'),
+                                                        request.form.getlist('expense_comment'))
+                         if et_id and amt]
+        # stock_id из скрытого поля формы (если продажа из стока)
+        stock_id = request.form.get('stock_id', type=int)
+
+        try:
+            create_sale(fields, expense_lines, stock_id)
+        except ValueError as e:
+            # Продажа не создана — принятое фото не переносим в хранилище
+            for filename, temp_path in g.pop('received_photos', []):
+                discard_photo(filename, temp_path)
+            flash(str(e), 'error')
+            return redirect(url_for('stock'))
+
+        if stock_id:
             flash('Продажа добавлена! Сток помечен как проданный.', 'success')
         else:
             flash('Продажа добавлена!', 'success')
-        
+
         return redirect(url_for('sales'))
 
+    ref = get_reference_data()
+
+    # Получаем stock_id из параметров запроса (если переходим из стока)
+    stock_id = request.args.get('stock_id', type=int)
+    stock_item = None
+    if stock_id:
+        stock_item = StockItem.query.get(stock_id)
+        if not stock_item:
+            flash('Сток не найден!', 'error')
+            return redirect(url_for('stock'))
+
     # Для GET запроса - автозаполняем форму данными из стока
     stock_data = {}
     if stock_item:
@@ -659,18 +1847,19 @@ def add_sale():
         }
 
     return render_template('add_sale.html', 
-                         cities=cities, 
-                         expense_types=expense_types, 
-                         employees=employees, 
-                         investors=investors,
+                         cities=ref.cities, 
+                         expense_types=ref.expense_types, 
+                         employees=ref.employees, 
+                         investors=ref.investors,
                          stock_data=stock_data)
 
 
 @app.route('/add_stock', methods=['GET', 'POST'])
 def add_stock():
-    cities = City.query.all()
-    expense_types = ExpenseType.query.all()
-    investors = Investor.query.all()
+    ref = get_reference_data()
+    cities = ref.cities
+    expense_types = ref.expense_types
+    investors = ref.investors
 
     if request.method == 'POST':
         product_name = request.form['product_name']
@@ -683,35 +1872,38 @@ def add_stock():
         photo_path = None
         photo = request.files['photo']
         if photo and allowed_file(photo.filename):
-            filename = secure_filename(photo.filename)
-            photo_path = filename
-            photo.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-
-        new_stock = StockItem(
-            photo=photo_path,
-            product_name=product_name,
-            reference=reference,
-            buy_price=buy_price,
-            expected_sell_price=expected_sell_price,
-            city_id=city_id,
-            investor_id=investor_id
-        )
-        db.session.add(new_stock)
-        db.session.flush()  # Получаем ID нового стока
+            try:
+                photo_path = receive_photo(photo)
+            except ValueError as e:
+                flash(str(e), 'error')
+                return redirect(request.url)
 
-        # Добавление расходов
         expense_type_ids = request.form.getlist('expense_type_id')
         amounts = request.form.getlist('expense_amount')
-        for et_id, amt in zip(expense_type_ids, amounts):
-            if et_id and amt:
-                stock_expense = StockExpense(
-                    stock_item_id=new_stock.id,
-                    expense_type_id=int(et_id),
-                    amount=float(amt)
-                )
-                db.session.add(stock_expense)
-
-        db.session.commit()
+
+        with write_transaction():
+            new_stock = StockItem(
+                photo=photo_path,
+                product_name=product_name,
+                reference=reference,
+                buy_price=buy_price,
+                expected_sell_price=expected_sell_price,
+                city_id=city_id,
+                investor_id=investor_id
+            )
+            db.session.add(new_stock)
+            db.session.flush()  # Получаем ID нового стока
+
+            # Добавление расходов
+            for et_id, amt in zip(expense_type_ids, amounts):
+                if et_id and amt:
+                    stock_expense = StockExpense(
+                        stock_item_id=new_stock.id,
+                        expense_type_id=int(et_id),
+                        amount=float(amt)
+                    )
+                    db.session.add(stock_expense)
+
         flash('Сток добавлен!', 'success')
         return redirect(url_for('stock'))
 
@@ -721,40 +1913,48 @@ def add_stock():
 @app.route('/edit_stock/<int:stock_id>', methods=['GET', 'POST'])
 def edit_stock(stock_id):
     stock_item = StockItem.query.get_or_404(stock_id)
-    cities = City.query.all()
-    investors = Investor.query.all()
-    expense_types = ExpenseType.query.all()
+    ref = get_reference_data()
+    cities = ref.cities
+    investors = ref.investors
+    expense_types = ref.expense_types
 
     if request.method == 'POST':
-        stock_item.product_name = request.form['product_name']
-        stock_item.reference = request.form.get('reference', '')
-        stock_item.buy_price = float(request.form['buy_price'])
-        stock_item.expected_sell_price = float(request.form['expected_sell_price'])
-        stock_item.quantity = int(request.form.get('quantity', 1))
-        stock_item.city_id = int(request.form['city_id'])
-        stock_item.investor_id = int(request.form['investor_id'])
-
+        # Файл принимаем до транзакции, чтобы не держать блокировку записи на время загрузки
+        photo_filename = None
         photo = request.files['photo']
         if photo and allowed_file(photo.filename):
-            filename = secure_filename(photo.filename)
-            photo.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            stock_item.photo = filename
+            try:
+                photo_filename = receive_photo(photo)
+            except ValueError as e:
+                flash(str(e), 'error')
+                return redirect(request.url)
+
+        with write_transaction():
+            stock_item.product_name = request.form['product_name']
+            stock_item.reference = request.form.get('reference', '')
+            stock_item.buy_price = float(request.form['buy_price'])
+            stock_item.expected_sell_price = float(request.form['expected_sell_price'])
+            stock_item.quantity = int(request.form.get('quantity', 1))
+            stock_item.city_id = int(request.form['city_id'])
+            stock_item.investor_id = int(request.form['investor_id'])
+            # Замененное фото остается в uploads: файлы без ссылок убирает cleanup_uploads.py
+            if photo_filename:
+                stock_item.photo = photo_filename
+
+            # Обновление расходов
+            for exp in stock_item.expenses:
+                db.session.delete(exp)
+            expense_type_ids = request.form.getlist('expense_type_id')
+            amounts = request.form.getlist('expense_amount')
+            for et_id, amt in zip(expense_type_ids, amounts):
+                if et_id and amt:
+                    stock_expense = StockExpense(
+                        stock_item_id=stock_item.id,
+                        expense_type_id=int(et_id),
+                        amount=float(amt)
+                    )
+                    db.session.add(stock_expense)
 
-        # Обновление расходов
-        for exp in stock_item.expenses:
-            db.session.delete(exp)
-        expense_type_ids = request.form.getlist('expense_type_id')
-        amounts = request.form.getlist('expense_amount')
-        for et_id, amt in zip(expense_type_ids, amounts):
-            if et_id and amt:
-                stock_expense = StockExpense(
-                    stock_item_id=stock_item.id,
-                    expense_type_id=int(et_id),
-                    amount=float(amt)
-                )
-                db.session.add(stock_expense)
-
-        db.session.commit()
         flash('Сток обновлен!', 'success')
         return redirect(request.referrer or url_for('stock'))
 
@@ -764,8 +1964,8 @@ def edit_stock(stock_id):
 @app.route('/sell_stock/<int:stock_id>', methods=['POST'])
 def sell_stock(stock_id):
     stock_item = StockItem.query.get_or_404(stock_id)
-    stock_item.sold = True
-    db.session.commit()
+    with write_transaction():
+        stock_item.sold = True
     flash('Позиция помечена как проданная!', 'success')
     return redirect(request.referrer or url_for('stock'))
 
@@ -773,39 +1973,47 @@ def sell_stock(stock_id):
 @app.route('/edit_sale/<int:sale_id>', methods=['GET', 'POST'])
 def edit_sale(sale_id):
     sale = Sale.query.get_or_404(sale_id)
-    cities = City.query.all()
-    expense_types = ExpenseType.query.all()
-    employees = Employee.query.all()
-    investors = Investor.query.all()
+    ref = get_reference_data()
+    cities = ref.cities
+    expense_types = ref.expense_types
+    employees = ref.employees
+    investors = ref.investors
 
     if request.method == 'POST':
-        sale.product_name = request.form['product_name']
-        sale.reference = request.form.get('reference', '')
-        sale.buy_price = float(request.form['buy_price'])
-        sale.sell_price = float(request.form['sell_price'])
-        sale.city_id = int(request.form['city_id'])
-        sale.employee_id = int(request.form['employee_id'])
-        sale.investor_id = int(request.form.get('investor_id')) if request.form.get('investor_id') else None
-        date_str = request.form['date']
-        sale.date = datetime.strptime(date_str, '%Y-%m-%d') if date_str else datetime.utcnow()
-
+        # Файл принимаем до транзакции, чтобы не держать блокировку записи на время загрузки
+        photo_filename = None
         photo = request.files['photo']
         if photo and allowed_file(photo.filename):
-            filename = secure_filename(photo.filename)
-            photo.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            sale.photo = filename
-
-        # Обновление расходов
-        for exp in sale.expenses:
-            db.session.delete(exp)
-        expense_type_ids = request.form.getlist('expense_type_id')
-        amounts = request.form.getlist('expense_amount')
-        for et_id, amt in zip(expense_type_ids, amounts):
-            if et_id and amt:
-                expense = Expense(sale_id=sale.id, expense_type_id=int(et_id), amount=float(amt))
-                db.session.add(expense)
+            try:
+                photo_filename = receive_photo(photo)
+            except ValueError as e:
+                flash(str(e), 'error')
+                return redirect(request.url)
+
+        with write_transaction():
+            sale.product_name = request.form['product_name']
+            sale.reference = request.form.get('reference', '')
+            sale.buy_price = float(request.form['buy_price'])
+            sale.sell_price = float(request.form['sell_price'])
+            sale.city_id = int(request.form['city_id'])
+            sale.employee_id = int(request.form['employee_id'])
+            sale.investor_id = int(request.form.get('investor_id')) if request.form.get('investor_id') else None
+            date_str = request.form['date']
+            sale.date = datetime.strptime(date_str, '%Y-%m-%d') if date_str else datetime.utcnow()
+            # Замененное фото остается в uploads: файлы без ссылок убирает cleanup_uploads.py
+            if photo_filename:
+                sale.photo = photo_filename
+
+            # Обновление расходов
+            for exp in sale.expenses:
+                db.session.delete(exp)
+            expense_type_ids = request.form.getlist('expense_type_id')
+            amounts = request.form.getlist('expense_amount')
+            for et_id, amt in zip(expense_type_ids, amounts):
+                if et_id and amt:
+                    expense = Expense(sale_id=sale.id, expense_type_id=int(et_id), amount=float(amt))
+                    db.session.add(expense)
 
-        db.session.commit()
         flash('Продажа обновлена!', 'success')
         return redirect(url_for('sales'))
 
@@ -816,115 +2024,53 @@ def edit_sale(sale_id):
 def delete_sale(sale_id):
     sale = Sale.query.get_or_404(sale_id)
 
-    if sale.photo:
-        photo_path = os.path.join(app.config['UPLOAD_FOLDER'], sale.photo)
-        if os.path.exists(photo_path):
-            os.remove(photo_path)
+    # Файл фото не удаляем сразу: пока эта транзакция идет, другой запрос может сохранить продажу
+    # с тем же фото (хранилище по хэшу). Файлы без ссылок убирает cleanup_uploads.py
+    with write_transaction():
+        db.session.delete(sale)
 
-    db.session.delete(sale)
-    db.session.commit()
     flash('Продажа удалена!', 'success')
     return redirect(url_for('sales'))
 
 
 @app.route('/stats', methods=['GET', 'POST'])
+@versioned_report('sale', 'expense', 'general_expense', 'reference', filters=stats_report_args)
 def stats():
     # Параметры периода и города
-    period_type = request.args.get('period_type', 'current_month')
-    year = request.args.get('year')
-    month = request.args.get('month')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+    period = parse_period(request.args)
+    period_type = 'custom' if period.custom else 'current_month'
+    start, end = period.start, period.end
     city_filter = request.args.get('city', 'all')
 
-    # Определяем даты
-    if period_type == 'custom' and start_date and end_date:
-        start = datetime.strptime(start_date, '%Y-%m-%d').date()
-        end = datetime.strptime(end_date, '%Y-%m-%d').date()
-        end = end + relativedelta(days=1)
-    else:
-        today = date.today()
-        if year and month:
-            try:
-                selected_date = date(int(year), int(month), 1)
-            except:
-                selected_date = today
-        else:
-            selected_date = today
-        start = selected_date.replace(day=1)
-        end = start + relativedelta(months=1)
-
     # Фильтры для продаж и расходов
     sales_query = Sale.query.filter(Sale.date >= start, Sale.date < end)
-    general_exp_query = GeneralExpense.query.filter(GeneralExpense.date >= start, GeneralExpense.date < end)
+    sale_criteria = []
+    general_criteria = []
 
     if city_filter != 'all':
-        sales_query = sales_query.filter(Sale.city_id == City.query.filter_by(name=city_filter).first().id)
-        general_exp_query = general_exp_query.filter(GeneralExpense.city_id == City.query.filter_by(name=city_filter).first().id)
+        city_id = get_reference_data().city_ids.get(city_filter)
+        sales_query = sales_query.filter(Sale.city_id == city_id)
+        sale_criteria.append(Sale.city_id == city_id)
+        general_criteria.append(GeneralExpense.city_id == city_id)
 
-    sales = sales_query.all()
-    general_expenses = general_exp_query.all()
-
-    # Группируем расходы по датам
-    expenses_by_date = {}
-    total_expenses = 0
-    
-    # Расходы из продаж (используем дату продажи)
-    for s in sales:
-        sale_date = s.date.date() if isinstance(s.date, datetime) else s.date
-        if sale_date not in expenses_by_date:
-            expenses_by_date[sale_date] = []
-        for e in s.expenses:
-            expenses_by_date[sale_date].append({
-                'type': e.expense_type.name,
-                'amount': e.amount,
-                'description': e.comment,  # Комментарий из расходов продажи
-                'is_sale_expense': True
-            })
-            total_expenses += e.amount
-    
-    # Общие расходы (используем дату расхода)
-    for g in general_expenses:
-        exp_date = g.date.date() if isinstance(g.date, datetime) else g.date
-        if exp_date not in expenses_by_date:
-            expenses_by_date[exp_date] = []
-        expenses_by_date[exp_date].append({
-            'type': g.expense_type.name,
-            'amount': g.amount,
-            'description': g.description,  # Комментарий для общих расходов
-            'is_sale_expense': False
-        })
-        total_expenses += g.amount
-    
-    # Сортируем даты по убыванию (новые сначала)
-    sorted_expenses_by_date = sorted(expenses_by_date.items(), key=lambda x: x[0], reverse=True)
+    # Расходы по датам (новые сначала) — один запрос, группировка и сортировка в SQL
+    expenses_by_date = get_expense_timeline(start, end, sale_criteria, general_criteria)
+    total_expenses = sum(expense.amount for _, expenses in expenses_by_date for expense in expenses)
 
     # Общая чистая прибыль (для полноты, но фокус на расходах)
-    gross_income = sum(s.sell_price for s in sales)
-    total_buy = sum(s.buy_price for s in sales)
-    net_profit = gross_income - total_buy - total_expenses
-
-    # Период лейбл
-    months_ru = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
-                 'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
-    month_name = months_ru[start.month - 1]
-    if period_type == 'custom':
-        period_label = f"{start.strftime('%d.%m.%Y')} — {(end - relativedelta(days=1)).strftime('%d.%m.%Y')}"
-    else:
-        period_label = f"{month_name} {start.year}"
+    totals = get_sales_totals(sales_query)
+    net_profit = totals.gross_income - totals.total_buy - total_expenses
 
-    all_years = sorted(set(s.date.year for s in Sale.query.with_entities(Sale.date).all()), reverse=True)
-    if not all_years:
-        all_years = [date.today().year]
-    all_cities = sorted([c.name for c in City.query.all()])
+    all_years = get_sale_years()
+    all_cities = sorted(get_reference_data().city_ids)
 
-    expense_types = ExpenseType.query.all()
-    cities = City.query.all()
+    expense_types = get_reference_data().expense_types
+    cities = get_reference_data().cities
 
     return render_template('stats.html',
                            total_expenses=round(total_expenses, 2),
-                           expenses_by_date=sorted_expenses_by_date,
-                           period_label=period_label,
+                           expenses_by_date=expenses_by_date,
+                           period_label=period.label,
                            all_years=all_years,
                            selected_year=start.year,
                            selected_month=start.month,
@@ -933,7 +2079,10 @@ def stats():
                            all_cities=all_cities,
                            expense_types=expense_types,
                            cities=cities,
-                           net_profit=round(net_profit, 2))
+                           net_profit=round(net_profit, 2),
+                           report_args=g.report_args,
+                           # Выгрузке явно передается period_type: без него она берет всю историю, а не текущий месяц
+                           export_args=dict(g.report_args, period_type=period_type))
 
 
 # Добавление общего расхода
@@ -946,9 +2095,9 @@ def add_general_expense():
     city_id = int(request.form['city_id']) if request.form['city_id'] != 'none' else None
     description = request.form.get('description', '')
 
-    new_gen_exp = GeneralExpense(expense_type_id=expense_type_id, amount=amount, date=date, city_id=city_id, description=description)
-    db.session.add(new_gen_exp)
-    db.session.commit()
+    with write_transaction():
+        new_gen_exp = GeneralExpense(expense_type_id=expense_type_id, amount=amount, date=date, city_id=city_id, description=description)
+        db.session.add(new_gen_exp)
     flash('Общий расход добавлен!', 'success')
     return redirect(url_for('stats'))
 
@@ -958,9 +2107,9 @@ def add_general_expense():
 def add_city():
     name = request.form['name'].strip()
     if name and not City.query.filter_by(name=name).first():
-        new_city = City(name=name)
-        db.session.add(new_city)
-        db.session.commit()
+        with write_transaction():
+            new_city = City(name=name)
+            db.session.add(new_city)
         flash('Город добавлен!', 'success')
     else:
         flash('Город уже существует или пустое имя.', 'error')
@@ -971,9 +2120,9 @@ def add_city():
 def add_expense_type():
     name = request.form['name'].strip()
     if name and not ExpenseType.query.filter_by(name=name).first():
-        new_type = ExpenseType(name=name)
-        db.session.add(new_type)
-        db.session.commit()
+        with write_transaction():
+            new_type = ExpenseType(name=name)
+            db.session.add(new_type)
         flash('Тип расхода добавлен!', 'success')
     else:
         flash('Тип уже существует или пустое имя.', 'error')
@@ -984,9 +2133,9 @@ def add_expense_type():
 def add_employee():
     name = request.form['name'].strip()
     if name:
-        new_employee = Employee(name=name)
-        db.session.add(new_employee)
-        db.session.commit()
+        with write_transaction():
+            new_employee = Employee(name=name)
+            db.session.add(new_employee)
         flash('Сотрудник добавлен!', 'success')
     else:
         flash('Пустое имя.', 'error')
@@ -997,9 +2146,9 @@ def add_employee():
 def add_investor():
     name = request.form['name'].strip()
     if name and not Investor.query.filter_by(name=name).first():
-        new_investor = Investor(name=name)
-        db.session.add(new_investor)
-        db.session.commit()
+        with write_transaction():
+            new_investor = Investor(name=name)
+            db.session.add(new_investor)
         flash('Инвестор добавлен!', 'success')
     else:
         flash('Инвестор уже существует или пустое имя.', 'error')
@@ -1007,14 +2156,24 @@ def add_investor():
 
 
 @app.route('/all_sales_summary')
+@versioned_report('sales_rollup', 'reference', filters=summary_report_args)
 def all_sales_summary():
-    # Получаем параметры фильтрации
-    year_filter = request.args.get('year', 'all')
-    month_filter = request.args.get('month', 'all')
-    city_filter = request.args.get('city', 'all')
-
-    # Базовый запрос
-    sales_query = Sale.query
+    # Фильтры уже разобраны summary_report_args (неверные год и месяц отброшены)
+    year_filter = g.report_args.get('year', 'all')
+    month_filter = g.report_args.get('month', 'all')
+    city_filter = g.report_args.get('city', 'all')
+
+    # Итоги берём из sales_rollup: по строке на город, инвестора и месяц вместо всей истории продаж
+    rollup_query = db.session.query(
+        City.name.label('city_name'),
+        SalesRollup.year,
+        SalesRollup.month,
+        func.sum(SalesRollup.sales_count).label('count'),
+        func.sum(SalesRollup.total_buy).label('total_buy'),
+        func.sum(SalesRollup.total_sell).label('total_sell'),
+        func.sum(SalesRollup.total_expenses).label('total_expenses')
+    ).join(City, SalesRollup.city_id == City.id) \
+        .group_by(City.name, SalesRollup.year, SalesRollup.month)
 
     # Фильтр по году и месяцу
     if year_filter != 'all':
@@ -1031,28 +2190,20 @@ def all_sales_summary():
             else:
                 start_date = date(year_int, 1, 1)
                 end_date = date(year_int + 1, 1, 1)
-            sales_query = sales_query.filter(Sale.date >= start_date, Sale.date < end_date)
+            rollup_query = rollup_query.filter(*rollup_period_criteria(start_date, end_date))
         except:
             pass
 
     # Фильтр по городу
     if city_filter != 'all':
-        sales_query = sales_query.join(City).filter(City.name == city_filter)
-
-    # Получаем все продажи
-    all_sales = sales_query.all()
+        rollup_query = rollup_query.filter(City.name == city_filter)
 
     # Группируем данные по городам и месяцам
     cities_data = {}
 
-    for sale in all_sales:
-        city_name = sale.city.name
-        sale_date = sale.date.date() if isinstance(sale.date, datetime) else sale.date
-        sale_month = sale_date.month
-        sale_year = sale_date.year
-        
-        if city_name not in cities_data:
-            cities_data[city_name] = {
+    for row in rollup_query.all():
+        if row.city_name not in cities_data:
+            cities_data[row.city_name] = {
                 'count': 0,
                 'total_buy': 0,
                 'total_sell': 0,
@@ -1063,30 +2214,21 @@ def all_sales_summary():
             }
 
         # Обновляем статистику города
-        data = cities_data[city_name]
-        data['count'] += 1
-        data['total_buy'] += sale.buy_price
-        data['total_sell'] += sale.sell_price
-
-        # Расходы этой продажи
-        sale_expenses = sum(e.amount for e in sale.expenses)
-        data['total_expenses'] += sale_expenses
-        
+        data = cities_data[row.city_name]
+        data['count'] += row.count
+        data['total_buy'] += row.total_buy
+        data['total_sell'] += row.total_sell
+        data['total_expenses'] += row.total_expenses
+
         # Группировка по месяцам
-        month_key = f"{sale_year}-{sale_month:02d}"
-        if month_key not in data['months']:
-            data['months'][month_key] = {
-                'count': 0,
-                'gross_profit': 0,
-                'net_profit': 0,
-                'month': sale_month,
-                'year': sale_year
-            }
-        
-        month_data = data['months'][month_key]
-        month_data['count'] += 1
-        month_data['gross_profit'] += (sale.sell_price - sale.buy_price)
-        month_data['net_profit'] += (sale.sell_price - sale.buy_price - sale_expenses)
+        month_key = f"{row.year}-{row.month:02d}"
+        data['months'][month_key] = {
+            'count': row.count,
+            'gross_profit': row.total_sell - row.total_buy,
+            'net_profit': row.total_sell - row.total_buy - row.total_expenses,
+            'month': row.month,
+            'year': row.year
+        }
     
     # Вычисляем итоговые прибыли и сортируем месяцы для каждого города
     for city_name, data in cities_data.items():
@@ -1095,12 +2237,10 @@ def all_sales_summary():
         data['months'] = dict(sorted(data['months'].items(), reverse=True))
     
     # Период для отображения
-    months_ru = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
-                 'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
     period_label = "Все продажи"
     if year_filter != 'all' and month_filter != 'all':
         try:
-            month_name = months_ru[int(month_filter) - 1]
+            month_name = MONTHS_RU[int(month_filter) - 1]
             period_label = f"{month_name} {year_filter}"
         except:
             period_label = f"{year_filter} год"
@@ -1108,10 +2248,8 @@ def all_sales_summary():
         period_label = f"{year_filter} год"
 
     # Список годов для фильтра
-    all_years = sorted(set(s.date.year for s in Sale.query.with_entities(Sale.date).all()), reverse=True)
-    if not all_years:
-        all_years = [date.today().year]
-    all_cities = sorted([c.name for c in City.query.all()])
+    all_years = get_sale_years()
+    all_cities = sorted(get_reference_data().city_ids)
 
     return render_template('all_sales_summary.html',
                            cities_data=cities_data,
@@ -1121,11 +2259,474 @@ def all_sales_summary():
                            selected_month=month_filter,
                            selected_city=city_filter,
                            period_label=period_label,
-                           months_ru=months_ru)
+                           months_ru=MONTHS_RU,
+                           export_args=g.report_args)
+
+
+# ВЫГРУЗКИ CSV/XLSX
+# Строки пишутся в ответ по мере чтения с курсора (yield_per), поэтому выгрузка за несколько лет
+# не держится в памяти и начинает скачиваться сразу. XLSX собирается без сторонних библиотек:
+# zipfile умеет писать архив в поток без seek, лист пишется строками inlineStr
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',  # charset=utf-8 Flask добавляет к текстовым типам сам
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+XLSX_EPOCH = date(1899, 12, 30)
+XLSX_INVALID_CHARS_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="{sheet}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'),
+    # Стиль 1 — встроенный формат даты (numFmtId 14)
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+        '</styleSheet>'),
+}
+
+
+class ChunkSink:
+    """Файл только для записи: байты копятся до выдачи очередным куском ответа"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def csv_chunks(sheet, header, rows):
+    """CSV в UTF-8 с BOM (Excel иначе не узнает кодировку); даты — ГГГГ-ММ-ДД"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([value.date().isoformat() if isinstance(value, datetime) else value for value in row])
+        if buffer.tell() >= app.config['STREAM_CHUNK_SIZE']:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, datetime):
+        value = value.date()
+    if isinstance(value, date):
+        return f'<c s="1"><v>{(value - XLSX_EPOCH).days}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c><v>{value!r}</v></c>'
+    text = xml_escape(XLSX_INVALID_CHARS_RE.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def xlsx_chunks(sheet, header, rows):
+    """Книга XLSX с одним листом, записываемая в ответ по мере чтения строк"""
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content.replace('{sheet}', xml_escape(sheet, {'"': '&quot;'})))
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as worksheet:
+            worksheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                            b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            worksheet.write(('<row>' + ''.join(map(xlsx_cell, header)) + '</row>').encode('utf-8'))
+            for row in rows:
+                worksheet.write(('<row>' + ''.join(map(xlsx_cell, row)) + '</row>').encode('utf-8'))
+                if sink.size >= app.config['STREAM_CHUNK_SIZE']:
+                    yield sink.take()
+            worksheet.write(b'</sheetData></worksheet>')
+    yield sink.take()
+
+
+def export_response(fmt, filename, sheet, header, rows):
+    """Потоковый ответ-файл; rows — генератор, который читает базу во время отправки"""
+    writer = csv_chunks if fmt == 'csv' else xlsx_chunks
+    response = app.response_class(stream_with_context(writer(sheet, header, rows)), mimetype=EXPORT_MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+    return response
+
+
+def export_date_range(args):
+    """Период выгрузки: period_type/start_date/end_date/year/month как у dashboard и stats,
+    year/month без period_type — как у списка продаж (month=all — весь год), без них — вся история"""
+    if args.get('period_type'):
+        period = parse_period(args)
+        return period.start, period.end
+    year_filter = args.get('year', 'all')
+    month_filter = args.get('month', 'all')
+    if year_filter == 'all':
+        return None
+    try:
+        year_int = int(year_filter)
+    except ValueError:
+        return None
+    try:
+        start_date = date(year_int, int(month_filter), 1)
+        return start_date, start_date + relativedelta(months=1)
+    except ValueError:
+        return date(year_int, 1, 1), date(year_int + 1, 1, 1)
+
+
+def export_reference_criteria(args, model):
+    """Условия city/investor выгрузки по названиям (неизвестное название — пустая выгрузка)"""
+    ref = get_reference_data()
+    criteria = []
+    city_filter = args.get('city', 'all')
+    if city_filter != 'all':
+        criteria.append(model.city_id == ref.city_ids.get(city_filter))
+    investor_filter = args.get('investor', 'all')
+    if investor_filter != 'all' and hasattr(model, 'investor_id'):
+        criteria.append(model.investor_id == ref.investor_ids.get(investor_filter))
+    return criteria
+
+
+def export_filename(prefix, date_range):
+    if date_range is None:
+        return prefix
+    start, end = date_range
+    return f"{prefix}_{start.isoformat()}_{(end - relativedelta(days=1)).isoformat()}"
+
+
+@app.route('/export/sales.<any(csv, xlsx):fmt>')
+def export_sales(fmt):
+    """Продажи с разбивкой расходов по типам (фильтры year, month, period_type, city, investor)"""
+    date_range = export_date_range(request.args)
+    criteria = export_reference_criteria(request.args, Sale)
+    if date_range is not None:
+        criteria += [Sale.date >= date_range[0], Sale.date < date_range[1]]
+
+    type_names = [item.name for item in get_reference_data().expense_types]
+    header = ['Дата', 'Наименование', 'Reference', 'Город', 'Инвестор', 'Продавец', 'Покупка', 'Продажа',
+              *type_names, 'Расходы', 'Прибыль']
+
+    def rows():
+        for sale in iter_sales(Sale.query.filter(*criteria), 'date_asc'):
+            by_type = dict.fromkeys(type_names, 0)
+            for expense in sale.expenses:
+                by_type[expense.type_name] = by_type.get(expense.type_name, 0) + expense.amount
+            yield (sale.date, sale.product_name, sale.reference, sale.city_name, sale.investor_name,
+                   sale.employee_name, sale.buy_price, sale.sell_price, *[by_type[name] for name in type_names],
+                   sale.expenses_total, sale.profit)
+
+    return export_response(fmt, export_filename('sales', date_range), 'Продажи', header, rows())
+
+
+@app.route('/export/stock.<any(csv, xlsx):fmt>')
+def export_stock(fmt):
+    """Непроданный сток (фильтры city, investor)"""
+    criteria = export_reference_criteria(request.args, StockItem)
+    header = ['Добавлено', 'Наименование', 'Reference', 'Город', 'Инвестор', 'Количество', 'Покупка',
+              'Выставлено', 'Вложено', 'Ожидаемая прибыль']
+
+    def rows():
+        for item in active_stock_rows(*criteria):
+            yield (item.date_added, item.product_name, item.reference, item.city_name, item.investor_name,
+                   item.quantity, item.buy_price, item.expected_sell_price, item.total_invested, item.expected_profit)
+
+    return export_response(fmt, 'stock', 'Сток', header, rows())
+
+
+@app.route('/export/general_expenses.<any(csv, xlsx):fmt>')
+def export_general_expenses(fmt):
+    """Журнал общих расходов (фильтры year, month, period_type, city)"""
+    date_range = export_date_range(request.args)
+    criteria = export_reference_criteria(request.args, GeneralExpense)
+    if date_range is not None:
+        criteria += [GeneralExpense.date >= date_range[0], GeneralExpense.date < date_range[1]]
+    header = ['Дата', 'Тип', 'Город', 'Описание', 'Сумма']
+
+    def rows():
+        ref = get_reference_data()
+        result = db.session.execute(
+            select(GeneralExpense.date, GeneralExpense.expense_type_id, GeneralExpense.city_id,
+                   GeneralExpense.description, GeneralExpense.amount)
+            .where(*criteria)
+            .order_by(GeneralExpense.date, GeneralExpense.id),
+            execution_options={'yield_per': app.config['STREAM_BATCH_SIZE']})
+        for row in result:
+            yield (row.date, ref.expense_type_names.get(row.expense_type_id), ref.city_names.get(row.city_id),
+                   row.description, row.amount)
+
+    return export_response(fmt, export_filename('general_expenses', date_range), 'Общие расходы', header, rows())
+
+
+# ИМПОРТ CSV
+# Формат совпадает с выгрузкой (/export/sales, /export/stock): колонки по заголовкам, колонка с названием
+# типа расхода — сумма расхода этого типа, производные колонки (Расходы, Прибыль...) пропускаются.
+# Названия городов, сотрудников, инвесторов и типов расходов разрешаются по словарям get_reference_data,
+# строки вставляются пачками (executemany) — одна транзакция на пачку
+IMPORT_KINDS = {
+    'sales': {
+        'title': 'Продажи',
+        'columns': {'Дата': 'date', 'Наименование': 'product_name', 'Reference': 'reference', 'Город': 'city',
+                    'Инвестор': 'investor', 'Продавец': 'employee', 'Покупка': 'buy_price', 'Продажа': 'sell_price'},
+        'required': ['date', 'product_name', 'city', 'employee', 'buy_price', 'sell_price'],
+        'derived': {'Расходы', 'Прибыль'},
+    },
+    'stock': {
+        'title': 'Сток',
+        'columns': {'Добавлено': 'date', 'Наименование': 'product_name', 'Reference': 'reference', 'Город': 'city',
+                    'Инвестор': 'investor', 'Количество': 'quantity', 'Покупка': 'buy_price',
+                    'Выставлено': 'expected_sell_price'},
+        'required': ['product_name', 'city', 'investor', 'buy_price', 'expected_sell_price'],
+        'derived': {'Вложено', 'Ожидаемая прибыль'},
+    },
+}
+IMPORT_DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%Y-%m-%d %H:%M:%S')
+
+ImportResult = namedtuple('ImportResult', ['imported', 'error_count', 'errors'])
+
+
+def parse_import_number(value):
+    """Число из CSV: допускаются пробелы между разрядами и десятичная запятая"""
+    cleaned = value.replace('\xa0', '').replace(' ', '')
+    if ',' in cleaned and '.' not in cleaned:
+        cleaned = cleaned.replace(',', '.')
+    try:
+        return float(cleaned)
+    except ValueError:
+        raise ValueError(f'«{value}» — не число') from None
+
+
+def parse_import_date(value):
+    for date_format in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError(f'дата «{value}» не в формате ГГГГ-ММ-ДД или ДД.ММ.ГГГГ')
+
+
+def import_columns(spec, header, ref):
+    """Назначение колонок по заголовку: ('field', поле), ('expense', id типа расхода) или None"""
+    columns = []
+    for title in (title.strip() for title in header):
+        if title in spec['columns']:
+            columns.append(('field', spec['columns'][title]))
+        elif title in ref.expense_type_ids:
+            columns.append(('expense', ref.expense_type_ids[title]))
+        elif title in spec['derived'] or not title:
+            columns.append(None)
+        else:
+            raise ValueError(f'неизвестная колонка «{title}»')
+    fields = {column[1] for column in columns if column and column[0] == 'field'}
+    titles = {field: title for title, field in spec['columns'].items()}
+    missing = [titles[field] for field in spec['required'] if field not in fields]
+    if missing:
+        raise ValueError('нет колонок: ' + ', '.join(missing))
+    return columns
+
+
+def lookup_reference(ids, name, what):
+    if name not in ids:
+        raise ValueError(f'{what} «{name}» не найден в справочнике')
+    return ids[name]
+
+
+def parse_import_row(kind, columns, row, ref):
+    """Строка CSV -> (запись для insert, [(id типа расхода, сумма)]); ValueError с описанием ошибки"""
+    raw = {}
+    expenses = []
+    for column, value in zip(columns, row):
+        value = value.strip()
+        if column is None or not value:
+            continue
+        target, key = column
+        if target == 'field':
+            raw[key] = value
+        else:
+            amount = parse_import_number(value)
+            if amount:
+                expenses.append((key, amount))
+
+    titles = {field: title for title, field in IMPORT_KINDS[kind]['columns'].items()}
+    missing = [titles[field] for field in IMPORT_KINDS[kind]['required'] if field not in raw]
+    if missing:
+        raise ValueError('не заполнено: ' + ', '.join(missing))
+
+    record = {
+        'product_name': raw['product_name'],
+        'reference': raw.get('reference', ''),
+        'buy_price': parse_import_number(raw['buy_price']),
+        'city_id': lookup_reference(ref.city_ids, raw['city'], 'город'),
+        'investor_id': lookup_reference(ref.investor_ids, raw['investor'], 'инвестор') if 'investor' in raw else None,
+        'photo': None,
+    }
+    if kind == 'sales':
+        record.update(
+            sell_price=parse_import_number(raw['sell_price']),
+            employee_id=lookup_reference(ref.employee_ids, raw['employee'], 'продавец'),
+            date=parse_import_date(raw['date']),
+        )
+    else:
+        quantity = parse_import_number(raw['quantity']) if 'quantity' in raw else 1
+        if quantity < 1 or quantity != int(quantity):
+            raise ValueError(f'количество «{raw["quantity"]}» должно быть целым и больше нуля')
+        record.update(
+            expected_sell_price=parse_import_number(raw['expected_sell_price']),
+            quantity=int(quantity),
+            date_added=parse_import_date(raw['date']) if 'date' in raw else datetime.utcnow(),
+            sold=False,
+        )
+    return record, expenses
+
+
+def insert_import_batch(kind, batch):
+    """Пачка строк одной транзакцией: executemany записей и их расходов, затем один раз на пачку —
+    sales_rollup и версии данных (вставка в обход ORM не вызывает before_flush/after_flush)"""
+    model, expense_model, foreign_key = (Sale, Expense, 'sale_id') if kind == 'sales' \
+        else (StockItem, StockExpense, 'stock_item_id')
+    table = model.__table__
+    with write_transaction():
+        connection = db.session.connection()
+        ids = connection.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True),
+                                 [record for record, _ in batch]).scalars().all()
+        expenses = [{foreign_key: record_id, 'expense_type_id': expense_type_id, 'amount': amount}
+                    for record_id, (_, lines) in zip(ids, batch) for expense_type_id, amount in lines]
+        if expenses:
+            connection.execute(insert(expense_model.__table__), expenses)
+
+        tables = {VERSIONED_MODELS[model]}
+        if expenses:
+            tables.add(VERSIONED_MODELS[expense_model])
+        if kind == 'sales':
+            refresh_sales_rollup(connection, {sales_rollup_key(record['city_id'], record['investor_id'], record['date'])
+                                              for record, _ in batch})
+            tables.add('sales_rollup')
+        for name in sorted(tables | {'global'}):
+            bump_data_version(name, connection)
+
+
+def iter_import_rows(kind, text_stream, ref):
+    """Строки файла -> (номер строки, (запись, расходы)) или (номер строки, ValueError строки).
+    Ошибка заголовка — ValueError, ошибка кодировки — UnicodeDecodeError (прерывают чтение)"""
+    # Excel с русской локалью сохраняет CSV через точку с запятой
+    header_line = text_stream.readline()
+    delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+    columns = import_columns(IMPORT_KINDS[kind], next(csv.reader([header_line], delimiter=delimiter), []), ref)
+
+    reader = csv.reader(text_stream, delimiter=delimiter)
+    for row in reader:
+        if not any(value.strip() for value in row):
+            continue
+        try:
+            parsed = parse_import_row(kind, columns, row, ref)
+        except ValueError as error:
+            parsed = error
+        yield reader.line_num + 1, parsed  # +1 — строка заголовка
+
+
+def import_csv(kind, text_stream, batch_size=None, check_only=False):
+    """Импорт CSV (kind — 'sales' или 'stock') из текстового потока с поддержкой seek. Строки с ошибками
+    пропускаются и попадают в отчет, остальные вставляются пачками по batch_size (check_only — только проверка).
+    Файл сначала читается и проверяется целиком: ошибка заголовка или кодировки в любом месте файла —
+    исключение до вставки первой строки, а не половина файла в базе"""
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+    ref = get_reference_data()
+
+    imported = 0
+    error_count = 0
+    errors = []
+    for line, parsed in iter_import_rows(kind, text_stream, ref):
+        if isinstance(parsed, ValueError):
+            error_count += 1
+            if len(errors) < app.config['IMPORT_MAX_ERRORS']:
+                errors.append((line, str(parsed)))
+        else:
+            imported += 1
+    if check_only or not imported:
+        return ImportResult(imported, error_count, errors)
+
+    # Второй проход по тому же файлу — вставка; в памяти только одна пачка
+    text_stream.seek(0)
+    batch = []
+    for _, parsed in iter_import_rows(kind, text_stream, ref):
+        if isinstance(parsed, ValueError):
+            continue
+        batch.append(parsed)
+        if len(batch) >= batch_size:
+            insert_import_batch(kind, batch)
+            batch = []
+    if batch:
+        insert_import_batch(kind, batch)
+    return ImportResult(imported, error_count, errors)
+
+
+@app.route('/import', methods=['GET', 'POST'])
+def import_data():
+    result = None
+    if request.method == 'POST':
+        kind = request.form.get('kind')
+        upload = request.files.get('file')
+        if kind not in IMPORT_KINDS or not upload or not upload.filename:
+            flash('Выберите, что импортировать, и файл CSV', 'error')
+            return redirect(url_for('import_data'))
+        try:
+            result = import_csv(kind, io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''),
+                                check_only=bool(request.form.get('check_only')))
+        except UnicodeDecodeError:
+            flash('Файл должен быть в кодировке UTF-8', 'error')
+            return redirect(url_for('import_data'))
+        except ValueError as e:
+            flash(f'Файл не импортирован: {e}', 'error')
+            return redirect(url_for('import_data'))
+
+    return render_template('import.html',
+                           result=result,
+                           kinds=IMPORT_KINDS,
+                           selected_kind=request.form.get('kind', 'sales'),
+                           check_only=bool(request.form.get('check_only')),
+                           expense_types=get_reference_data().expense_types)
 
 
 if __name__ == '__main__':
+    from migrations import run_migrations
+
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     with app.app_context():
-        db.create_all()
+        run_migrations(db.engine)
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Сборка мусора в папке uploads: удаляет (или переносит в карантин) фото, на которые
+не ссылается ни одна продажа и ни одна позиция стока, их уменьшенные копии
+и брошенные временные файлы загрузок. В конце печатает, сколько места освобождено.
+
+Память не зависит от числа файлов: ссылки из базы читаются пачками уже отсортированными
+(сортирует SQLite), папка обходится в том же порядке, и два потока сравниваются слиянием.
+Свежие файлы (моложе --min-age-hours) не трогаются, чтобы не удалить фото,
+которое загружается прямо сейчас.
+
+Перед удалением ссылки на пачку файлов проверяются еще раз, и проверка вместе с удалением идет
+под блокировкой записи базы (BEGIN IMMEDIATE, как у write_transaction): пока пачка удаляется,
+ни один воркер не зафиксирует новую ссылку на эти файлы. Фото из формы переносится в хранилище
+только после commit продажи, поэтому ссылка, зафиксированная после удаления, получит файл заново.
+Остающееся окно: записи в базу в обход write_transaction (ручные правки, сторонние скрипты)
+и временный файл загрузки, перенос которого задержался дольше --min-age-hours.
+
+Использование:
+  python cleanup_uploads.py                  # только отчет, ничего не удаляется
+  python cleanup_uploads.py --quarantine     # перенести в uploads_quarantine/
+  python cleanup_uploads.py --delete         # удалить
+
+По расписанию (cron, каждую ночь в 4:00):
+  0 4 * * * cd /path/to/dauricrm && python cleanup_uploads.py --quarantine
+"""
+import argparse
+import os
+import shutil
+import time
+from stat import S_ISREG
+
+from sqlalchemy import select, union
+
+from app import app, db
+from app import Sale, StockItem, write_transaction
+
+# Файлы оформления, которые лежат в uploads, но не ссылаются из базы
+PROTECTED_FILES = {'logo.png'}
+REFERENCE_BATCH_SIZE = 1000
+
+
+def walk_sorted(root, relative=''):
+    """Файлы папки root в порядке сортировки относительных путей (как ORDER BY в SQLite).
+    Ключ name + '/' для папок дает тот же порядок, что и сравнение полных путей.
+    В памяти держатся только имена одной папки (при раскладке по хэшу — 1/256 всех фото)"""
+    directory = os.path.join(root, relative) if relative else root
+    with os.scandir(directory) as entries:
+        keys = sorted(entry.name + '/' if entry.is_dir(follow_symlinks=False) else entry.name
+                      for entry in entries)
+    for key in keys:
+        path = f'{relative}/{key}' if relative else key
+        if key.endswith('/'):
+            yield from walk_sorted(root, path[:-1])
+            continue
+        try:
+            info = os.lstat(os.path.join(root, path))
+        except FileNotFoundError:
+            continue  # файл удалили во время обхода
+        if S_ISREG(info.st_mode):
+            yield path, info
+
+
+def iter_references():
+    """Уникальные имена фото из sale и stock_item по возрастанию, пачками"""
+    references = union(
+        select(Sale.photo.label('photo')).where(Sale.photo.isnot(None)),
+        select(StockItem.photo.label('photo')).where(StockItem.photo.isnot(None)),
+    ).order_by('photo')
+    result = db.session.execute(references, execution_options={'yield_per': REFERENCE_BATCH_SIZE})
+    for (photo,) in result:
+        yield photo
+
+
+def referenced_photos(names):
+    """Какие из имен сейчас есть в sale или stock_item (одним запросом на пачку)"""
+    query = union(
+        select(Sale.photo).where(Sale.photo.in_(names)),
+        select(StockItem.photo).where(StockItem.photo.in_(names)),
+    )
+    return set(db.session.execute(query).scalars())
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def find_orphans(upload_folder, skip_dirs, min_age):
+    """Файлы без ссылок из базы: слияние отсортированного обхода папки и отсортированных ссылок"""
+    references = iter_references()
+    reference = next(references, None)
+    now = time.time()
+    for path, info in walk_sorted(upload_folder):
+        if path.split('/', 1)[0] in skip_dirs or path in PROTECTED_FILES:
+            continue
+        while reference is not None and reference < path:
+            reference = next(references, None)
+        if reference == path:
+            continue
+        if now - info.st_mtime < min_age:
+            continue
+        yield path, info.st_size
+
+
+def find_orphan_variants(variants_folder, upload_folder, min_age):
+    """Уменьшенные копии, оригинала которых уже нет, и копии размеров, убранных из PHOTO_VARIANTS"""
+    if not os.path.isdir(variants_folder):
+        return
+    now = time.time()
+    for path, info in walk_sorted(variants_folder):
+        variant, _, name = path.partition('/')
+        original = name[:-len('.webp')] if name.endswith('.webp') else None
+        if (variant in app.config['PHOTO_VARIANTS'] and original
+                and os.path.exists(os.path.join(upload_folder, original))):
+            continue
+        if now - info.st_mtime < min_age:
+            continue
+        yield path, info.st_size
+
+
+def find_stale_temp_files(temp_folder, min_age):
+    """Временные файлы загрузок, которые так и не были перенесены в хранилище"""
+    if not os.path.isdir(temp_folder):
+        return
+    now = time.time()
+    for path, info in walk_sorted(temp_folder):
+        if now - info.st_mtime >= min_age:
+            yield path, info.st_size
+
+
+def remove_file(root, path, quarantine):
+    source = os.path.join(root, path)
+    if quarantine:
+        target = os.path.join(quarantine, os.path.relpath(source, app.config['UPLOAD_FOLDER']))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(source, target)
+    else:
+        os.remove(source)
+
+
+def cleanup_uploads(mode='report', quarantine_folder='uploads_quarantine', min_age_hours=24):
+    """Находит и удаляет/переносит ненужные файлы; возвращает {вид: [количество, байт]}"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    variants_folder = app.config['PHOTO_VARIANTS_FOLDER']
+    temp_folder = app.config['UPLOAD_TEMP_FOLDER']
+    skip_dirs = {os.path.relpath(variants_folder, upload_folder), os.path.relpath(temp_folder, upload_folder)}
+    quarantine = quarantine_folder if mode == 'quarantine' else None
+    min_age = min_age_hours * 3600
+    totals = {'photos': [0, 0], 'variants': [0, 0], 'temp': [0, 0]}
+
+    def collect_batch(kind, root, batch):
+        # Список ссылок мог устареть за время обхода — перед удалением проверяем пачку еще раз
+        still_referenced = referenced_photos([path for path, _ in batch]) if kind == 'photos' else set()
+        for path, size in batch:
+            if path in still_referenced:
+                continue
+            if mode != 'report':
+                remove_file(root, path, quarantine)
+            totals[kind][0] += 1
+            totals[kind][1] += size
+
+    def collect(kind, root, orphans):
+        for batch in batched(orphans, REFERENCE_BATCH_SIZE):
+            if kind == 'photos' and mode != 'report':
+                # Проверка и удаление — под блокировкой записи: между ними новая ссылка не появится
+                with write_transaction():
+                    collect_batch(kind, root, batch)
+            else:
+                collect_batch(kind, root, batch)
+
+    with app.app_context():
+        collect('photos', upload_folder, find_orphans(upload_folder, skip_dirs, min_age))
+        collect('variants', variants_folder, find_orphan_variants(variants_folder, upload_folder, min_age))
+        collect('temp', temp_folder, find_stale_temp_files(temp_folder, min_age))
+        db.session.remove()
+    return totals
+
+
+def format_size(size):
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024 or unit == 'ГБ':
+            return f'{size:.1f} {unit}' if unit != 'Б' else f'{size} {unit}'
+        size /= 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Удаление фото без ссылок из базы')
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--delete', action='store_true', help='удалить найденные файлы')
+    action.add_argument('--quarantine', nargs='?', const='uploads_quarantine', metavar='DIR',
+                        help='перенести найденные файлы в папку (по умолчанию uploads_quarantine)')
+    parser.add_argument('--min-age-hours', type=float, default=24,
+                        help='не трогать файлы моложе указанного числа часов (по умолчанию 24)')
+    args = parser.parse_args()
+
+    mode = 'delete' if args.delete else 'quarantine' if args.quarantine else 'report'
+    print("=" * 50)
+    print("Очистка папки uploads" + (" (только отчет)" if mode == 'report' else ""))
+    print("=" * 50)
+
+    totals = cleanup_uploads(mode, args.quarantine, args.min_age_hours)
+
+    labels = {'photos': 'Фото без ссылок', 'variants': 'Копии без оригинала', 'temp': 'Временные файлы'}
+    for kind, (count, size) in totals.items():
+        print(f"  {labels[kind]}: {count} ({format_size(size)})")
+    reclaimed = sum(size for _, size in totals.values())
+    verb = {'report': 'Можно освободить', 'delete': 'Освобождено', 'quarantine': 'Перенесено в карантин'}[mode]
+    print(f"\n✅ {verb}: {format_size(reclaimed)}")
+    print("=" * 50)
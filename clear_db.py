@@ -4,7 +4,7 @@
 Использование: python clear_db.py
 """
 from app import app, db
-from app import City, ExpenseType, Employee, Sale, Expense, GeneralExpense
+from app import City, ExpenseType, Employee, Sale, Expense, GeneralExpense, SalesRollup, bump_data_version
 
 def clear_database():
     """Очищает все таблицы базы данных"""
@@ -27,6 +27,8 @@ def clear_database():
         print("\n3. Удаление продаж...")
         count_sale = Sale.query.count()
         Sale.query.delete()
+        # Итоги по продажам удаляем вместе с продажами (массовое удаление не обновляет sales_rollup)
+        SalesRollup.query.delete()
         print(f"   Удалено записей: {count_sale}")
         
         print("\n4. Удаление сотрудников...")
@@ -44,6 +46,10 @@ def clear_database():
         City.query.delete()
         print(f"   Удалено записей: {count_city}")
         
+        # Массовое удаление не проходит через flush — сбрасываем кэши и ETag отчетов явно
+        for name in ('reference', 'sale', 'expense', 'general_expense', 'sales_rollup', 'global'):
+            bump_data_version(name)
+        
         # Сохраняем изменения
         db.session.commit()
         
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Импорт продаж или стока из CSV (например, история продаж нового города).
+Формат — как у выгрузки /export/sales.csv и /export/stock.csv; расходы — колонки с названием типа расхода.
+Строки с ошибками пропускаются и печатаются с номерами, остальные вставляются пачками,
+по одной транзакции на пачку.
+
+Использование:
+  python import_csv.py sales history.csv                  # импорт продаж
+  python import_csv.py stock stock.csv --batch-size 1000  # импорт стока пачками по 1000 строк
+  python import_csv.py sales history.csv --check          # только проверка, ничего не сохраняется
+"""
+import argparse
+import sys
+
+from app import app, db
+from app import IMPORT_KINDS, import_csv
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Импорт продаж или стока из CSV')
+    parser.add_argument('kind', choices=sorted(IMPORT_KINDS), help='что импортировать')
+    parser.add_argument('path', help='файл CSV в кодировке UTF-8')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help=f"строк в одной транзакции (по умолчанию {app.config['IMPORT_BATCH_SIZE']})")
+    parser.add_argument('--check', action='store_true', help='только проверить файл, ничего не сохранять')
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print(f"Импорт: {IMPORT_KINDS[args.kind]['title']}" + (" (только проверка)" if args.check else ""))
+    print("=" * 50)
+
+    with app.app_context(), open(args.path, encoding='utf-8-sig', newline='') as csv_file:
+        try:
+            result = import_csv(args.kind, csv_file, args.batch_size, check_only=args.check)
+        except ValueError as e:
+            print(f"\n❌ Файл не импортирован: {e}")
+            sys.exit(1)
+        finally:
+            db.session.remove()
+
+    for line, message in result.errors:
+        print(f"  Строка {line}: {message}")
+    if result.error_count > len(result.errors):
+        print(f"  ...и еще {result.error_count - len(result.errors)}")
+    verb = 'Строк без ошибок' if args.check else 'Импортировано строк'
+    print(f"\n✅ {verb}: {result.imported}, с ошибками: {result.error_count}")
+    print("=" * 50)
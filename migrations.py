@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Версионные миграции схемы базы данных (SQLite).
+Номер примененной версии хранится в PRAGMA user_version. При запуске применяются
+только миграции с большим номером, все в одной транзакции BEGIN IMMEDIATE, поэтому
+одновременный старт нескольких воркеров gunicorn безопасен: остальные ждут и видят готовую схему.
+Миграции запускаются автоматически из wsgi.py и app.py.
+Использование вручную: python migrations.py
+"""
+
+
+def table_columns(connection, table):
+    return {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def add_column_if_missing(connection, table, column, definition):
+    if column not in table_columns(connection, table):
+        connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def stock_item_table_sql(table):
+    """DDL таблицы stock_item (используется и при пересоздании таблицы)"""
+    return f"""CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER NOT NULL,
+        city_id INTEGER NOT NULL,
+        investor_id INTEGER,
+        product_name VARCHAR(200) NOT NULL,
+        reference VARCHAR(200),
+        buy_price FLOAT NOT NULL,
+        expected_sell_price FLOAT NOT NULL,
+        quantity INTEGER,
+        photo VARCHAR(200),
+        date_added DATETIME,
+        sold BOOLEAN DEFAULT 0 NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(city_id) REFERENCES city (id),
+        FOREIGN KEY(investor_id) REFERENCES investor (id)
+    )"""
+
+
+def migration_001_base_tables(connection):
+    """Базовые таблицы (для новой базы)"""
+    statements = [
+        """CREATE TABLE IF NOT EXISTS city (
+            id INTEGER NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (name)
+        )""",
+        """CREATE TABLE IF NOT EXISTS expense_type (
+            id INTEGER NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (name)
+        )""",
+        """CREATE TABLE IF NOT EXISTS employee (
+            id INTEGER NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS investor (
+            id INTEGER NOT NULL,
+            name VARCHAR(100) NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (name)
+        )""",
+        """CREATE TABLE IF NOT EXISTS sale (
+            id INTEGER NOT NULL,
+            photo VARCHAR(200),
+            product_name VARCHAR(200) NOT NULL,
+            reference VARCHAR(200),
+            buy_price FLOAT NOT NULL,
+            sell_price FLOAT NOT NULL,
+            city_id INTEGER NOT NULL,
+            employee_id INTEGER NOT NULL,
+            investor_id INTEGER,
+            date DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(city_id) REFERENCES city (id),
+            FOREIGN KEY(employee_id) REFERENCES employee (id),
+            FOREIGN KEY(investor_id) REFERENCES investor (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS expense (
+            id INTEGER NOT NULL,
+            sale_id INTEGER NOT NULL,
+            expense_type_id INTEGER NOT NULL,
+            amount FLOAT NOT NULL,
+            comment VARCHAR(200),
+            PRIMARY KEY (id),
+            FOREIGN KEY(sale_id) REFERENCES sale (id),
+            FOREIGN KEY(expense_type_id) REFERENCES expense_type (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS general_expense (
+            id INTEGER NOT NULL,
+            expense_type_id INTEGER NOT NULL,
+            amount FLOAT NOT NULL,
+            date DATETIME,
+            city_id INTEGER,
+            description VARCHAR(200),
+            PRIMARY KEY (id),
+            FOREIGN KEY(expense_type_id) REFERENCES expense_type (id),
+            FOREIGN KEY(city_id) REFERENCES city (id)
+        )""",
+        stock_item_table_sql('stock_item'),
+        """CREATE TABLE IF NOT EXISTS stock_expense (
+            id INTEGER NOT NULL,
+            stock_item_id INTEGER NOT NULL,
+            expense_type_id INTEGER NOT NULL,
+            amount FLOAT NOT NULL,
+            comment VARCHAR(200),
+            PRIMARY KEY (id),
+            FOREIGN KEY(stock_item_id) REFERENCES stock_item (id),
+            FOREIGN KEY(expense_type_id) REFERENCES expense_type (id)
+        )""",
+    ]
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+
+
+def migration_002_legacy_columns(connection):
+    """Колонки, которые раньше добавлялись разовыми скриптами add_*_column.py"""
+    add_column_if_missing(connection, 'sale', 'reference', 'VARCHAR(200)')
+    add_column_if_missing(connection, 'sale', 'investor_id', 'INTEGER')
+    add_column_if_missing(connection, 'expense', 'comment', 'VARCHAR(200)')
+    add_column_if_missing(connection, 'stock_item', 'investor_id', 'INTEGER')
+    add_column_if_missing(connection, 'stock_item', 'sold', 'BOOLEAN DEFAULT 0 NOT NULL')
+
+
+def migration_003_rollup_and_versions(connection):
+    """Таблицы sales_rollup (итоги продаж по месяцам) и data_version (версии кэшей)"""
+    connection.exec_driver_sql("""CREATE TABLE IF NOT EXISTS sales_rollup (
+        id INTEGER NOT NULL,
+        city_id INTEGER NOT NULL,
+        investor_id INTEGER,
+        year INTEGER NOT NULL,
+        month INTEGER NOT NULL,
+        sales_count INTEGER NOT NULL,
+        total_buy FLOAT NOT NULL,
+        total_sell FLOAT NOT NULL,
+        total_expenses FLOAT NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(city_id) REFERENCES city (id),
+        FOREIGN KEY(investor_id) REFERENCES investor (id)
+    )""")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_sales_rollup_period ON sales_rollup (year, month, city_id)")
+    connection.exec_driver_sql("""CREATE TABLE IF NOT EXISTS data_version (
+        name VARCHAR(50) NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (name)
+    )""")
+
+
+def migration_004_indexes(connection):
+    """Индексы под фильтры по датам, городам и инвесторам"""
+    indexes = [
+        "CREATE INDEX IF NOT EXISTS ix_sale_date ON sale (date)",
+        "CREATE INDEX IF NOT EXISTS ix_sale_city_id_date ON sale (city_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_sale_investor_id_date ON sale (investor_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_expense_sale_id ON expense (sale_id)",
+        "CREATE INDEX IF NOT EXISTS ix_stock_expense_stock_item_id ON stock_expense (stock_item_id)",
+        "CREATE INDEX IF NOT EXISTS ix_general_expense_date_city_id ON general_expense (date, city_id)",
+        "CREATE INDEX IF NOT EXISTS ix_stock_item_sold_city_id ON stock_item (sold, city_id)",
+    ]
+    for statement in indexes:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql("ANALYZE")
+
+
+def migration_005_fill_sales_rollup(connection):
+    """Первичное заполнение sales_rollup по существующим продажам"""
+    connection.exec_driver_sql("DELETE FROM sales_rollup")
+    connection.exec_driver_sql("""INSERT INTO sales_rollup
+        (city_id, investor_id, year, month, sales_count, total_buy, total_sell, total_expenses)
+        SELECT s.city_id, s.investor_id,
+               CAST(strftime('%Y', s.date) AS INTEGER), CAST(strftime('%m', s.date) AS INTEGER),
+               COUNT(*), SUM(s.buy_price), SUM(s.sell_price), COALESCE(SUM(e.total), 0)
+        FROM sale s
+        LEFT JOIN (SELECT sale_id, SUM(amount) AS total FROM expense GROUP BY sale_id) e ON e.sale_id = s.id
+        WHERE s.date IS NOT NULL
+        GROUP BY s.city_id, s.investor_id, strftime('%Y', s.date), strftime('%m', s.date)""")
+    connection.exec_driver_sql("""INSERT INTO data_version (name, version) VALUES ('sales_rollup', 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1""")
+
+
+def migration_006_active_stock_indexes(connection):
+    """sold без NULL и частичные индексы по непроданному стоку"""
+    connection.exec_driver_sql("UPDATE stock_item SET sold = 0 WHERE sold IS NULL")
+
+    # SQLite не умеет менять ограничения колонки: если sold допускает NULL, пересоздаем таблицу
+    sold_column = [row for row in connection.exec_driver_sql("PRAGMA table_info(stock_item)") if row[1] == 'sold'][0]
+    if not sold_column[3]:
+        columns = ('id, city_id, investor_id, product_name, reference, buy_price, '
+                   'expected_sell_price, quantity, photo, date_added')
+        connection.exec_driver_sql(stock_item_table_sql('stock_item_new'))
+        connection.exec_driver_sql(f"""INSERT INTO stock_item_new ({columns}, sold)
+            SELECT {columns}, COALESCE(sold, 0) FROM stock_item""")
+        connection.exec_driver_sql("DROP TABLE stock_item")
+        connection.exec_driver_sql("ALTER TABLE stock_item_new RENAME TO stock_item")
+
+    # Вместо (sold, city_id): в индексы попадают только непроданные позиции
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_stock_item_sold_city_id")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_stock_item_active_city_id ON stock_item (city_id) WHERE sold = 0")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_stock_item_active_investor_id ON stock_item (investor_id) WHERE sold = 0")
+    connection.exec_driver_sql("ANALYZE stock_item")
+
+
+def migration_007_photo_indexes(connection):
+    """Индексы по фото: проверка ссылок перед удалением файла"""
+    connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_sale_photo ON sale (photo)")
+    connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_stock_item_photo ON stock_item (photo)")
+
+
+# Порядок важен: номер миграции — это версия схемы после ее применения
+MIGRATIONS = [
+    (1, 'Базовые таблицы', migration_001_base_tables),
+    (2, 'Колонки из старых скриптов add_*_column.py', migration_002_legacy_columns),
+    (3, 'Таблицы sales_rollup и data_version', migration_003_rollup_and_versions),
+    (4, 'Индексы для фильтров отчетов', migration_004_indexes),
+    (5, 'Заполнение sales_rollup', migration_005_fill_sales_rollup),
+    (6, 'sold NOT NULL и частичные индексы непроданного стока', migration_006_active_stock_indexes),
+    (7, 'Индексы по фото', migration_007_photo_indexes),
+]
+
+
+def get_schema_version(connection):
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def run_migrations(engine):
+    """Применяет недостающие миграции и возвращает список примененных (номер, описание)"""
+    applied = []
+    with engine.connect() as connection:
+        # Другие воркеры ждут, пока первый закончит миграции, а не падают с "database is locked".
+        # Соединение вернется в пул, поэтому прежний busy_timeout (из SQLITE_PRAGMAS) затем восстанавливается
+        busy_timeout = connection.exec_driver_sql("PRAGMA busy_timeout").scalar()
+        connection.exec_driver_sql("PRAGMA busy_timeout = 60000")
+        try:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                version = get_schema_version(connection)
+                for number, description, migrate in MIGRATIONS:
+                    if number > version:
+                        migrate(connection)
+                        connection.exec_driver_sql(f"PRAGMA user_version = {number}")
+                        applied.append((number, description))
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+        finally:
+            connection.exec_driver_sql(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+    return applied
+
+
+if __name__ == '__main__':
+    from app import app, db
+
+    with app.app_context():
+        print("=" * 50)
+        print("Миграции базы данных")
+        print("=" * 50)
+
+        applied = run_migrations(db.engine)
+        for number, description in applied:
+            print(f"  ✅ {number:03d}: {description}")
+        if not applied:
+            print("\n✅ Схема уже актуальна")
+
+        with db.engine.connect() as connection:
+            print(f"\nВерсия схемы: {get_schema_version(connection)}")
+        print("=" * 50)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Скрипт для полной пересборки таблицы sales_rollup (итоги продаж по городам, инвесторам и месяцам).
+Таблица поддерживается автоматически при каждом изменении продаж и расходов;
+пересборка нужна при первом запуске и после изменений в базе в обход приложения.
+Использование: python rebuild_sales_rollup.py
+"""
+from app import app, db
+from app import SalesRollup, rebuild_sales_rollup
+from migrations import run_migrations
+
+
+def rebuild():
+    """Создает таблицу sales_rollup (если ее нет) и заполняет ее заново"""
+    with app.app_context():
+        print("=" * 50)
+        print("Пересборка таблицы sales_rollup")
+        print("=" * 50)
+
+        try:
+            # Создаем таблицу, если ее еще нет
+            run_migrations(db.engine)
+            rebuild_sales_rollup()
+            print(f"\n✅ Готово! Строк в sales_rollup: {SalesRollup.query.count()}")
+            print("=" * 50)
+
+        except Exception as e:
+            print(f"\n❌ Ошибка при пересборке: {e}")
+            print("=" * 50)
+            raise
+
+
+if __name__ == '__main__':
+    rebuild()
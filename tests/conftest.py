@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Отдельная база и кэш отчетов для тестов: настройки app.py переопределяются через FLASK_* до импорта
+TEST_DIR = tempfile.mkdtemp(prefix='dauricrm-tests-')
+os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(TEST_DIR, 'sales.db')
+os.environ['FLASK_REPORT_CACHE_PATH'] = os.path.join(TEST_DIR, 'report_cache.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app, db, write_transaction  # noqa: E402
+from app import City, Employee, ExpenseType, Investor  # noqa: E402
+from migrations import run_migrations  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        run_migrations(db.engine)
+        with write_transaction():
+            db.session.add_all([City(name='Москва'), Employee(name='Русл'),
+                                Investor(name='Москва бутик'), ExpenseType(name='Доставка')])
+        db.session.remove()
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,58 @@
+import io
+
+from app import Sale, db
+
+HEADER = 'Дата,Наименование,Reference,Город,Инвестор,Продавец,Покупка,Продажа,Доставка\n'
+
+
+def sale_rows(count):
+    return ''.join(f'2026-02-{number % 28 + 1:02d},Часы {number},R{number},Москва,,Русл,1000,1500,20\n'
+                   for number in range(count))
+
+
+def sale_count(app):
+    with app.app_context():
+        count = db.session.query(Sale).count()
+        db.session.remove()
+        return count
+
+
+def post_import(client, data, **form):
+    return client.post('/import', data={'kind': 'sales', 'file': (io.BytesIO(data), 'sales.csv'), **form},
+                       content_type='multipart/form-data', follow_redirects=True)
+
+
+def test_import_inserts_valid_rows_and_reports_errors(app, client):
+    before = sale_count(app)
+    data = (HEADER + sale_rows(3) + '2026-02-30,Часы,,Москва,,Русл,1000,1500,\n').encode('utf-8')
+
+    response = post_import(client, data)
+
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert 'Импортировано строк: 3' in page
+    assert 'Строка 5:' in page
+    assert sale_count(app) == before + 3
+
+
+def test_check_only_saves_nothing(app, client):
+    before = sale_count(app)
+
+    response = post_import(client, (HEADER + sale_rows(3)).encode('utf-8'), check_only='1')
+
+    assert 'Строк без ошибок (не сохранено): 3' in response.get_data(as_text=True)
+    assert sale_count(app) == before
+
+
+def test_decode_error_mid_file_imports_nothing(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMPORT_BATCH_SIZE', 2)
+    before = sale_count(app)
+    # Неверные байты дальше первого блока, который читает TextIOWrapper (8 КБ)
+    valid = (HEADER + sale_rows(300)).encode('utf-8')
+    assert len(valid) > 16 * 1024
+    data = valid + b'2026-02-06,\xff\xfe,,\xd0,,,1,2,\n'
+
+    response = post_import(client, data)
+
+    assert 'Файл должен быть в кодировке UTF-8' in response.get_data(as_text=True)
+    assert sale_count(app) == before
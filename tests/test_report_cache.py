@@ -0,0 +1,42 @@
+import sqlite3
+from datetime import date
+
+import pytest
+
+from app import report_cache
+
+
+def cache_keys(app):
+    with sqlite3.connect(app.config['REPORT_CACHE_PATH']) as connection:
+        return {key for (key,) in connection.execute('SELECT key FROM report_cache')}
+
+
+def current_month_args():
+    today = date.today()
+    return f'year={today.year}&month={today.month}'
+
+
+@pytest.mark.parametrize('urls', [
+    ['/dashboard', '/dashboard?period_type=current_month', f'/dashboard?{current_month_args()}',
+     '/dashboard?year=&month=', '/dashboard?unknown=1'],
+    ['/stats', '/stats?city=all', '/stats?fmt=x', f'/stats?city=all&{current_month_args()}'],
+    ['/all_sales_summary', '/all_sales_summary?year=all&city=all', '/all_sales_summary?month=5',
+     '/all_sales_summary?year=abc'],
+    ['/all_sales_summary?year=2026', '/all_sales_summary?year=2026&month=13'],
+])
+def test_equivalent_urls_share_cache_entry_and_etag(app, client, urls):
+    report_cache.connection()  # создает таблицу кэша
+    etag = client.get(urls[0]).headers['ETag']
+    keys = cache_keys(app)
+
+    assert etag.strip('"') in keys
+    assert {client.get(url).headers['ETag'] for url in urls[1:]} == {etag}
+    assert cache_keys(app) == keys
+
+
+def test_different_filters_get_different_etags(client):
+    urls = ['/dashboard', '/dashboard?year=2020&month=1', '/dashboard?compare=1',
+            '/dashboard?period_type=custom&start_date=2020-01-01&end_date=2020-01-31',
+            '/stats?city=Москва']
+
+    assert len({client.get(url).headers['ETag'] for url in urls}) == len(urls)
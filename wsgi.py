@@ -9,7 +9,12 @@ import os
 project_root = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, project_root)
 
-from app import app
+from app import app, db
+from migrations import run_migrations
+
+# Применяем недостающие миграции схемы при старте каждого воркера (повторный запуск ничего не делает)
+with app.app_context():
+    run_migrations(db.engine)
 
 if __name__ == "__main__":
     app.run()